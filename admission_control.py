@@ -0,0 +1,92 @@
+import math
+import threading
+import time
+
+
+class Rejected(Exception):
+
+    def __init__(self, reason, message, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """Bounded queue in front of the estimators, shedding frames that would be late.
+
+    At most concurrency requests estimate at a time and at most max_queue
+    wait for their turn, more are refused right away as "queue_full". A
+    request with a due time (wall clock seconds) is refused as "deadline"
+    when the expected wait plus one estimate would end after it, and again
+    if it is still waiting when it falls due. The expected wait comes from a
+    moving average of the time per estimated frame.
+
+    check() applies the same refusals without taking a slot, to shed a
+    request before any work is done for it. Every refusal carries the
+    seconds after which a retry may be admitted.
+    """
+
+    def __init__(self, concurrency, max_queue, smoothing=0.1):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.smoothing = smoothing
+        self.running = 0
+        self.waiting = 0
+        self.frame_seconds = 0.0
+        self._cond = threading.Condition()
+
+    def check(self, due=None):
+        """Raise Rejected if a request acquiring a slot now would be refused."""
+        with self._cond:
+            self._check(due)
+
+    def acquire(self, due=None):
+        """Wait for a free slot, every successful acquire must be followed by a release."""
+        with self._cond:
+            remaining = self._check(due)
+
+            if self.running >= self.concurrency:
+                self.waiting += 1
+                try:
+                    deadline = time.monotonic() + remaining if due is not None else None
+                    while self.running >= self.concurrency:
+                        timeout = deadline - time.monotonic() if deadline is not None else None
+                        if timeout is not None and timeout <= 0:
+                            raise Rejected("deadline", "the frame fell due while waiting", self._retry_after(self._expected_wait()))
+                        self._cond.wait(timeout)
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+
+    def release(self, seconds=None, frames=1):
+        """Free the slot, seconds is the time it took to estimate frames."""
+        with self._cond:
+            self.running -= 1
+            if seconds is not None and frames:
+                per_frame = seconds / frames
+                if self.frame_seconds:
+                    self.frame_seconds += self.smoothing * (per_frame - self.frame_seconds)
+                else:
+                    self.frame_seconds = per_frame
+            self._cond.notify()
+
+    def _check(self, due):
+        # called with the lock held, returns the seconds until due
+        expected_wait = self._expected_wait()
+        if self.running >= self.concurrency and self.waiting >= self.max_queue:
+            raise Rejected("queue_full", "the estimate queue is full", self._retry_after(expected_wait))
+        if due is None:
+            return None
+        remaining = due - time.time()
+        if remaining < expected_wait + self.frame_seconds:
+            raise Rejected("deadline", "the frame would be estimated after its deadline", self._retry_after(expected_wait))
+        return remaining
+
+    def _expected_wait(self):
+        # the requests ahead, run concurrency at a time
+        ahead = self.running + self.waiting - self.concurrency + 1
+        return max(ahead, 0) * self.frame_seconds / self.concurrency
+
+    @staticmethod
+    def _retry_after(expected_wait):
+        return max(1, math.ceil(expected_wait))
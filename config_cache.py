@@ -0,0 +1,138 @@
+import queue
+import threading
+from collections import OrderedDict
+from estimator_registry import create_estimator
+from pmu_schemas import estimator_config, configuration_key, configuration_window_size
+
+
+class PreparedConfig:
+    """A /configure document with everything derived from it computed once.
+
+    Holds the EstimatorConfig, its canonical key, the window geometry and a
+    small stock of freshly configured, never used estimators. The estimator
+    tables live inside the C library and cannot be copied between instances,
+    so a "clone" is handing out one of these spares; the cache tops the
+    stock up again in the background.
+    """
+
+    def __init__(self, configuration, key, spares, refill=None):
+        self.configuration = configuration
+        self.key = key
+        self.config = estimator_config(configuration)
+        self.window_size = configuration_window_size(configuration)
+        self.sample_rate = configuration['signal']['sample_rate']
+        self.frame_rate = configuration['synchrophasor']['frame_rate']
+        self.spares = spares
+        self.evicted = False
+        self._spares = []
+        self._lock = threading.Lock()
+        self._refill = refill
+
+        # one instance is built right away, a bad configuration fails here
+        self._spares.append(create_estimator(self.config))
+        if spares == 0:
+            self._spares.pop().deinit()
+
+    def spawn(self):
+        """Return a freshly configured estimator, owned by the caller."""
+        with self._lock:
+            estimator = self._spares.pop() if self._spares else None
+
+        if self._refill is not None:
+            self._refill(self)
+
+        if estimator is None:
+            estimator = create_estimator(self.config)
+        return estimator
+
+    def top_up(self):
+        while not self.evicted:
+            with self._lock:
+                if len(self._spares) >= self.spares:
+                    return
+            estimator = create_estimator(self.config)
+            with self._lock:
+                if not self.evicted:
+                    self._spares.append(estimator)
+                    estimator = None
+            if estimator is not None:
+                estimator.deinit()
+
+    def release(self):
+        with self._lock:
+            self.evicted = True
+            spares, self._spares = self._spares, []
+        for estimator in spares:
+            estimator.deinit()
+
+
+class ConfigCache:
+    """LRU cache of PreparedConfig keyed by the canonical configuration hash.
+
+    Configuring to a configuration seen before is a dictionary lookup instead
+    of building and checking a new estimator configuration.
+    """
+
+    def __init__(self, max_size=32, spares=2):
+        self.max_size = max_size
+        self.spares = spares
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = queue.Queue()
+        self._filler = None
+
+    def prepare(self, configuration):
+        key = configuration_key(configuration)
+
+        with self._lock:
+            prepared = self._entries.get(key)
+            if prepared is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return prepared
+            self.misses += 1
+
+        # built outside the lock, this is the expensive part
+        prepared = PreparedConfig(configuration, key, self.spares, self._schedule_top_up)
+
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is None:
+                self._entries[key] = prepared
+                evicted = []
+                while len(self._entries) > self.max_size:
+                    evicted.append(self._entries.popitem(last=False)[1])
+            else:
+                # another thread prepared the same configuration meanwhile
+                evicted = [prepared]
+                prepared = existing
+
+        for stale in evicted:
+            stale.release()
+
+        self._schedule_top_up(prepared)
+        return prepared
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _schedule_top_up(self, prepared):
+        if not self.spares:
+            return
+        with self._lock:
+            if self._filler is None:
+                self._filler = threading.Thread(target=self._fill, daemon=True)
+                self._filler.start()
+        self._pending.put(prepared)
+
+    def _fill(self):
+        while True:
+            prepared = self._pending.get()
+            try:
+                prepared.top_up()
+            except Exception:
+                # spares are an optimization, spawn() builds its own when
+                # the stock is empty
+                pass
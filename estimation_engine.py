@@ -0,0 +1,571 @@
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict
+import numpy as np
+from estimator_registry import EstimatorRegistry, EstimatorConfigError, EstimatorNotConfigured
+from config_cache import ConfigCache
+from frame_codec import SAMPLE_DTYPE, RESULT_DTYPE, FrameDecodeError, result_records
+
+
+# seconds between sweeps for estimators idle longer than their registry's
+# ttl, which are otherwise only evicted as a side effect of lookups
+EVICT_INTERVAL = 30.0
+
+
+class EngineError(Exception):
+    pass
+
+
+def parse_cpu_list(cpu_list):
+    """Parse a cpu list such as "0-3,6" into a list of cpu ids."""
+    cpus = []
+    for part in cpu_list.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _check_window_sizes(windows, window_size):
+    # the decoder checks against the configuration it saw, this checks
+    # against the generation the frame actually runs on
+    for channel_number, samples in windows:
+        if len(samples) != window_size:
+            raise FrameDecodeError(f"channel {channel_number}: holds {len(samples)} samples, expected {window_size}")
+
+
+def _channel_matrix(channel_numbers, samples):
+    samples = np.asarray(samples, dtype=SAMPLE_DTYPE)
+    if samples.ndim != 2 or samples.shape[0] != len(channel_numbers):
+        raise FrameDecodeError(f"expected a ({len(channel_numbers)}, n_samples) sample array, got shape {samples.shape}")
+    return samples
+
+
+class InProcessEngine:
+    """Runs every channel in the calling thread, one after the other.
+
+    Streams configured on their own get their own registry of at most
+    max_channels estimators, all other streams share the default one.
+    """
+
+    def __init__(self, registry=None, max_channels=1024):
+        self.registry = registry if registry is not None else EstimatorRegistry()
+        self.max_channels = max_channels
+        self._streams = {}
+        self._streams_lock = threading.Lock()
+
+    @property
+    def generation(self):
+        generation = self.registry.generation
+        return generation.number if generation is not None else 0
+
+    def configure(self, prepared, number=None, stream_id=None):
+        """Swap in prepared and return its generation number, the next one unless given.
+
+        Configures stream_id on its own, or the default configuration if None.
+        """
+        if stream_id is None:
+            return self.registry.configure(prepared, number)
+
+        with self._streams_lock:
+            registry = self._streams.get(stream_id)
+            if registry is None:
+                registry = self._streams[stream_id] = EstimatorRegistry(max_entries=self.max_channels)
+        return registry.configure(prepared, number)
+
+    def reset(self, stream_id):
+        """Start the channels of a stream configured on its own over with fresh estimators."""
+        registry = self._streams.get(stream_id)
+        if registry is not None:
+            registry.clear()
+
+    def stock(self, prepared, spares):
+        """Keep at least spares freshly configured estimators of prepared in stock."""
+        prepared.spares = max(prepared.spares, spares)
+        prepared.top_up()
+
+    def evict_idle(self):
+        """Free the estimators of channels idle for longer than the registry ttl."""
+        with self._streams_lock:
+            registries = [self.registry] + list(self._streams.values())
+        for registry in registries:
+            registry.evict_idle()
+
+    def drop(self, stream_id):
+        """Forget the configuration of stream_id and free its estimators."""
+        with self._streams_lock:
+            registry = self._streams.pop(stream_id, None)
+        if registry is not None:
+            registry.close()
+
+    def estimate(self, stream_id, windows, mid_window_fracsec):
+        """Estimate a frame given as a list of (channel_number, samples).
+
+        Returns the generation number the frame ran on and the estimated
+        frames in the order of windows.
+        """
+        generation, results = self.estimate_batch(stream_id, [(windows, mid_window_fracsec)])
+        return generation, results[0]
+
+    def estimate_array(self, stream_id, channel_numbers, samples, mid_window_fracsec):
+        """Estimate a frame given as an (n_channels, n_samples) array, one row per channel.
+
+        Returns the generation number and one RESULT_DTYPE record per
+        channel, NaN for channels that failed. The estimator library works
+        on one channel at a time, so the rows are run one after the other
+        on a single pinned generation, without building per-channel windows
+        or result lists around the calls.
+        """
+        samples = _channel_matrix(channel_numbers, samples)
+        with self._streams.get(stream_id, self.registry).pin() as generation:
+            window_size = generation.prepared.window_size
+            if samples.shape[1] != window_size:
+                raise FrameDecodeError(f"channels hold {samples.shape[1]} samples, expected {window_size}")
+
+            estimated_frames = []
+            for channel_number, window in zip(channel_numbers, samples):
+                with generation.acquire((stream_id, channel_number)) as synchestim:
+                    estimated_frames.append(synchestim.estimate(window, mid_window_fracsec))
+
+        return generation.number, result_records(channel_numbers, estimated_frames, generation.number)
+
+    def estimate_batch(self, stream_id, frames):
+        """Estimate consecutive frames, each given as (windows, mid_window_fracsec).
+
+        Every channel runs through its frames in order while holding its
+        estimator, so its state advances from window to window without other
+        requests interleaving. All frames run on the same generation.
+        Returns its number and one list of estimated frames per frame.
+        """
+        results = [[None] * len(windows) for windows, _ in frames]
+
+        jobs = defaultdict(list)
+        for f, (windows, mid_window_fracsec) in enumerate(frames):
+            for c, (channel_number, samples) in enumerate(windows):
+                jobs[channel_number].append((f, c, samples, mid_window_fracsec))
+
+        with self._streams.get(stream_id, self.registry).pin() as generation:
+            for windows, _ in frames:
+                _check_window_sizes(windows, generation.prepared.window_size)
+
+            for channel_number, channel_jobs in jobs.items():
+                with generation.acquire((stream_id, channel_number)) as synchestim:
+                    for f, c, samples, mid_window_fracsec in channel_jobs:
+                        results[f][c] = synchestim.estimate(samples, mid_window_fracsec)
+
+        return generation.number, results
+
+    def close(self):
+        with self._streams_lock:
+            registries, self._streams = list(self._streams.values()), {}
+        for registry in registries:
+            registry.close()
+        self.registry.clear()
+
+
+def _attach_shared_memory(name):
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always registers the segment with the resource
+        # tracker, which would unlink it when this worker exits
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _worker_main(conn, cpus, spares, max_channels):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    # every worker prepares the configurations it is sent on its own, the
+    # estimators cannot cross the process boundary. Streams configured on
+    # their own have their own registry, the default one is under None.
+    config_cache = ConfigCache(spares=spares)
+    registries = {None: EstimatorRegistry()}
+    staged = {}
+    shm = None
+    samples = None
+    next_eviction = time.monotonic() + EVICT_INTERVAL
+
+    while True:
+        # idle estimators are evicted between messages, also when none come
+        now = time.monotonic()
+        if now >= next_eviction:
+            for registry in list(registries.values()):
+                registry.evict_idle()
+            next_eviction = now + EVICT_INTERVAL
+        try:
+            if not conn.poll(next_eviction - now):
+                continue
+            message = conn.recv()
+        except EOFError:
+            break
+
+        op = message[0]
+        try:
+            if op in ("estimate", "estimate_array"):
+                shm_name, stream_id = message[1], message[2]
+                if shm is None or shm.name != shm_name:
+                    if shm is not None:
+                        samples = None
+                        shm.close()
+                    shm = _attach_shared_memory(shm_name)
+                    samples = np.ndarray((shm.size // SAMPLE_DTYPE.itemsize,), dtype=SAMPLE_DTYPE, buffer=shm.buf)
+
+            if op == "estimate":
+                jobs = message[3]
+                results = []
+                with registries.get(stream_id, registries[None]).pin() as generation:
+                    window_size = generation.prepared.window_size
+                    for key, offset, n, mid_window_fracsec in jobs:
+                        if n != window_size:
+                            raise FrameDecodeError(f"channel {key[1]}: holds {n} samples, expected {window_size}")
+                    for key, offset, n, mid_window_fracsec in jobs:
+                        with generation.acquire(key) as synchestim:
+                            results.append(synchestim.estimate(samples[offset:offset + n], mid_window_fracsec))
+                conn.send(("ok", (generation.number, results)))
+
+            elif op == "estimate_array":
+                # the rows of this worker's channels, one block at the start of the segment
+                _, _, _, channel_numbers, n, mid_window_fracsec = message
+                with registries.get(stream_id, registries[None]).pin() as generation:
+                    window_size = generation.prepared.window_size
+                    if n != window_size:
+                        raise FrameDecodeError(f"channels hold {n} samples, expected {window_size}")
+                    estimated_frames = []
+                    for row, channel_number in enumerate(channel_numbers):
+                        with generation.acquire((stream_id, channel_number)) as synchestim:
+                            estimated_frames.append(synchestim.estimate(samples[row * n:(row + 1) * n], mid_window_fracsec))
+                conn.send(("ok", (generation.number, result_records(channel_numbers, estimated_frames, generation.number))))
+
+            elif op == "prepare":
+                # the slow part of a reconfiguration, estimates keep running
+                _, stream_id, configuration = message
+                staged[stream_id] = config_cache.prepare(configuration)
+                conn.send(("ok", None))
+
+            elif op == "activate":
+                _, stream_id, number = message
+                registry = registries.get(stream_id)
+                if registry is None:
+                    registry = registries[stream_id] = EstimatorRegistry(max_entries=max_channels)
+                registry.configure(staged.pop(stream_id), number)
+                conn.send(("ok", None))
+
+            elif op == "stock":
+                _, configuration, n_spares = message
+                prepared = config_cache.prepare(configuration)
+                prepared.spares = max(prepared.spares, n_spares)
+                prepared.top_up()
+                conn.send(("ok", None))
+
+            elif op == "reset":
+                registry = registries.get(message[1])
+                if registry is not None:
+                    registry.clear()
+                conn.send(("ok", None))
+
+            elif op == "drop":
+                registry = registries.pop(message[1], None)
+                if registry is not None:
+                    registry.close()
+                conn.send(("ok", None))
+
+            elif op == "stop":
+                break
+
+        except EstimatorNotConfigured as e:
+            conn.send(("not_configured", str(e)))
+        except EstimatorConfigError as e:
+            conn.send(("config_error", str(e)))
+        except FrameDecodeError as e:
+            conn.send(("bad_window", str(e)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+    if shm is not None:
+        samples = None
+        shm.close()
+    conn.close()
+
+
+class _Worker:
+
+    def __init__(self, context, cpus, spares, max_channels):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, cpus, spares, max_channels), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.lock = threading.Lock()
+        self.shm = None
+        self.samples = None
+
+    def reserve(self, n_samples):
+        # grow the shared sample buffer, the worker re-attaches when it sees
+        # a new segment name
+        if self.shm is not None and self.samples.size >= n_samples:
+            return
+        from multiprocessing import shared_memory
+        self.release()
+        self.shm = shared_memory.SharedMemory(create=True, size=max(n_samples, 1) * SAMPLE_DTYPE.itemsize)
+        self.samples = np.ndarray((n_samples,), dtype=SAMPLE_DTYPE, buffer=self.shm.buf)
+
+    def release(self):
+        if self.shm is not None:
+            self.samples = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def send(self, message):
+        self.conn.send(message)
+
+    def receive(self):
+        try:
+            status, result = self.conn.recv()
+        except EOFError:
+            raise EngineError(f"estimation worker {self.process.pid} died")
+
+        if status == "ok":
+            return result
+        if status == "not_configured":
+            raise EstimatorNotConfigured(result)
+        if status == "config_error":
+            raise EstimatorConfigError(result)
+        if status == "bad_window":
+            raise FrameDecodeError(result)
+        raise EngineError(result)
+
+
+class ProcessPoolEngine:
+    """Spreads the channels of a frame over a pool of worker processes.
+
+    Every (stream, channel) key is pinned to one worker, so its estimator and
+    filter state live in that worker for good. Sample windows are copied into
+    a shared memory segment per worker and only offsets go through the pipe.
+    The channels of one frame are sent to all involved workers before any
+    result is collected, so they are estimated in parallel.
+
+    Reconfiguring first prepares the configuration in every worker while
+    frames keep flowing, then activates the new generation in all workers at
+    once, so a frame never mixes two generations.
+    """
+
+    def __init__(self, workers=None, cpu_affinity=None, spares=2, max_channels=1024):
+        # imported here, the in-process engine never needs it
+        import multiprocessing
+
+        workers = workers or os.cpu_count() or 1
+        # fork, so that the workers do not re-import the server script
+        context = multiprocessing.get_context("fork")
+        self._workers = []
+        for i in range(workers):
+            cpus = [cpu_affinity[i % len(cpu_affinity)]] if cpu_affinity else None
+            self._workers.append(_Worker(context, cpus, spares, max_channels))
+        # generation numbers of the default configuration (None) and of
+        # the streams configured on their own
+        self._generations = {None: 0}
+        self._configure_lock = threading.Lock()
+
+    @property
+    def generation(self):
+        return self._generations[None]
+
+    def configure(self, prepared, number=None, stream_id=None):
+        """Swap in prepared in every worker and return its generation number, the next one unless given.
+
+        Configures stream_id on its own, or the default configuration if None.
+        """
+        # the /configure document travels, the workers look it up in their
+        # own configuration cache
+        with self._configure_lock:
+            errors = []
+            for worker in self._workers:
+                with worker.lock:
+                    worker.send(("prepare", stream_id, prepared.configuration))
+                    try:
+                        worker.receive()
+                    except EstimatorConfigError as e:
+                        errors.append(e)
+            if errors:
+                raise errors[0]
+
+            if number is None:
+                number = self._generations.get(stream_id, 0) + 1
+            self._lock_all(self._workers)
+            try:
+                for worker in self._workers:
+                    worker.send(("activate", stream_id, number))
+                for worker in self._workers:
+                    worker.receive()
+            finally:
+                self._unlock_all(self._workers)
+
+            self._generations[stream_id] = number
+            return number
+
+    def reset(self, stream_id):
+        """Start the channels of a stream configured on its own over with fresh estimators."""
+        for worker in self._workers:
+            with worker.lock:
+                worker.send(("reset", stream_id))
+                worker.receive()
+
+    def stock(self, prepared, spares):
+        """Keep at least spares freshly configured estimators of prepared in stock in every worker."""
+        self._lock_all(self._workers)
+        try:
+            for worker in self._workers:
+                worker.send(("stock", prepared.configuration, spares))
+            for worker in self._workers:
+                worker.receive()
+        finally:
+            self._unlock_all(self._workers)
+
+    def evict_idle(self):
+        # the workers sweep their registries on their own, every EVICT_INTERVAL
+        pass
+
+    def drop(self, stream_id):
+        """Forget the configuration of stream_id in every worker and free its estimators."""
+        with self._configure_lock:
+            self._generations.pop(stream_id, None)
+            for worker in self._workers:
+                with worker.lock:
+                    worker.send(("drop", stream_id))
+                    worker.receive()
+
+    def estimate(self, stream_id, windows, mid_window_fracsec):
+        """Estimate a frame given as a list of (channel_number, samples).
+
+        Returns the estimated frames in the order of windows.
+        """
+        generation, results = self.estimate_batch(stream_id, [(windows, mid_window_fracsec)])
+        return generation, results[0]
+
+    def estimate_array(self, stream_id, channel_numbers, samples, mid_window_fracsec):
+        """Estimate a frame given as an (n_channels, n_samples) array, see InProcessEngine.estimate_array.
+
+        The rows of each worker's channels are copied into its segment as one
+        block, and each worker answers with the result records of its rows.
+        """
+        samples = _channel_matrix(channel_numbers, samples)
+        n = samples.shape[1]
+        groups = defaultdict(list)
+        for row, channel_number in enumerate(channel_numbers):
+            groups[self._worker_index((stream_id, channel_number))].append(row)
+
+        involved = sorted(groups)
+        self._lock_all([self._workers[i] for i in involved])
+
+        try:
+            for i in involved:
+                worker = self._workers[i]
+                rows = groups[i]
+                worker.reserve(len(rows) * n)
+                worker.samples[:len(rows) * n].reshape(len(rows), n)[:] = samples[rows]
+                worker.send(("estimate_array", worker.shm.name, stream_id, [channel_numbers[row] for row in rows], n, mid_window_fracsec))
+
+            records = np.empty(len(channel_numbers), dtype=RESULT_DTYPE)
+            generation = None
+            error = None
+            for i in involved:
+                # collect every reply, even after an error, to keep the pipes in sync
+                try:
+                    generation, worker_records = self._workers[i].receive()
+                except Exception as e:
+                    error = error or e
+                    continue
+                records[groups[i]] = worker_records
+            if error is not None:
+                raise error
+
+            return generation, records
+
+        finally:
+            self._unlock_all([self._workers[i] for i in involved])
+
+    def estimate_batch(self, stream_id, frames):
+        """Estimate consecutive frames, each given as (windows, mid_window_fracsec).
+
+        Each worker gets all windows of its channels in one message and runs
+        them in frame order. Returns the generation number the frames ran on
+        and one list of estimated frames per frame.
+        """
+        groups = defaultdict(list)
+        for f, (windows, mid_window_fracsec) in enumerate(frames):
+            for c, (channel_number, samples) in enumerate(windows):
+                key = (stream_id, channel_number)
+                groups[self._worker_index(key)].append((f, c, key, samples, mid_window_fracsec))
+
+        involved = sorted(groups)
+        self._lock_all([self._workers[i] for i in involved])
+
+        try:
+            for i in involved:
+                worker = self._workers[i]
+                worker.reserve(sum(len(samples) for _, _, _, samples, _ in groups[i]))
+
+                jobs = []
+                offset = 0
+                for _, _, key, samples, mid_window_fracsec in groups[i]:
+                    n = len(samples)
+                    worker.samples[offset:offset + n] = samples
+                    jobs.append((key, offset, n, mid_window_fracsec))
+                    offset += n
+                worker.send(("estimate", worker.shm.name, stream_id, jobs))
+
+            results = [[None] * len(windows) for windows, _ in frames]
+            generation = None
+            error = None
+            for i in involved:
+                # collect every reply, even after an error, to keep the pipes in sync
+                try:
+                    generation, estimated = self._workers[i].receive()
+                except Exception as e:
+                    error = error or e
+                    continue
+                for (f, c, _, _, _), estimated_frame in zip(groups[i], estimated):
+                    results[f][c] = estimated_frame
+            if error is not None:
+                raise error
+
+            return generation, results
+
+        finally:
+            self._unlock_all([self._workers[i] for i in involved])
+
+    def close(self):
+        for worker in self._workers:
+            with worker.lock:
+                try:
+                    worker.send(("stop",))
+                except OSError:
+                    pass
+                worker.process.join(timeout=5)
+                worker.release()
+
+    @staticmethod
+    def _lock_all(workers):
+        # always lock workers in the same order so concurrent frames
+        # and reconfigurations cannot deadlock
+        for worker in workers:
+            worker.lock.acquire()
+
+    @staticmethod
+    def _unlock_all(workers):
+        for worker in workers:
+            worker.lock.release()
+
+    def _worker_index(self, key):
+        return zlib.crc32(repr(key).encode()) % len(self._workers)
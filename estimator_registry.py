@@ -0,0 +1,217 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pmu_estimator import PMUEstimator
+
+
+class EstimatorConfigError(Exception):
+    pass
+
+
+class EstimatorNotConfigured(Exception):
+    pass
+
+
+def create_estimator(config):
+    estimator = PMUEstimator()
+    if estimator.configure_from_class(config) != 0:
+        raise EstimatorConfigError("PMU estimator rejected the configuration")
+    return estimator
+
+
+class _Entry:
+    __slots__ = ("estimator", "lock", "last_used", "closed")
+
+    def __init__(self, estimator):
+        self.estimator = estimator
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.closed = False
+
+
+class Generation:
+    """One configuration of a registry and the estimators spawned from it.
+
+    A frame pins the generation it starts on and runs all of its channels on
+    it, even if the registry is reconfigured meanwhile. Once a generation is
+    replaced and its last frame is done, its estimators are deinitialized.
+    """
+
+    def __init__(self, registry, number, prepared):
+        self.number = number
+        self.prepared = prepared
+        self._registry = registry
+        self._entries = OrderedDict()
+        self._pinned = 0
+        self._retired = False
+
+    @contextmanager
+    def acquire(self, key):
+        """Yield the estimator of key with its lock held."""
+        while True:
+            entry, evicted = self._lookup(key)
+
+            for stale in evicted:
+                _close(stale)
+
+            with entry.lock:
+                # the entry may have been evicted while we waited for it
+                if entry.closed:
+                    continue
+                yield entry.estimator
+                return
+
+    def _lookup(self, key):
+        lock = self._registry._lock
+        estimator = None
+        while True:
+            now = time.monotonic()
+            with lock:
+                entry = self._entries.get(key)
+                if entry is None and estimator is not None:
+                    entry = _Entry(estimator)
+                    self._entries[key] = entry
+                    estimator = None
+
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.last_used = now
+                    evicted = self._collect_evicted(now, keep=key)
+                    break
+
+            # spawning an estimator can take a while, do it without holding
+            # the registry lock
+            estimator = self.prepared.spawn()
+
+        # another thread created the entry first
+        if estimator is not None:
+            estimator.deinit()
+
+        return entry, evicted
+
+    def _collect_evicted(self, now, keep=None):
+        # entries are kept in least recently used order
+        registry = self._registry
+        evicted = []
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            if len(self._entries) <= registry.max_entries and now - entry.last_used < registry.ttl:
+                break
+            del self._entries[key]
+            evicted.append(entry)
+        return evicted
+
+    def _take_entries(self):
+        entries = list(self._entries.values())
+        self._entries.clear()
+        return entries
+
+
+class EstimatorRegistry:
+    """Per-channel PMUEstimator instances keyed by (stream id, channel number).
+
+    Every key owns its own estimator, so the ROCOF filters and previous-frame
+    state of a channel are never shared with another channel or gateway.
+    Instances are spawned on demand from the PreparedConfig of the current
+    generation and each one is guarded by its own lock, the registry lock is
+    only held for the dictionary bookkeeping. Instances idle for longer than
+    ttl seconds, or the least recently used ones beyond max_entries, are
+    evicted and deinitialized.
+
+    Reconfiguring swaps in a new generation, frames already running finish
+    on the generation they pinned.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._current = None
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        return self._current
+
+    def configure(self, prepared, number=None):
+        """Make prepared the current configuration and return its generation number.
+
+        Every channel starts over with a fresh estimator.
+        """
+        with self._lock:
+            previous = self._current
+            if number is None:
+                number = previous.number + 1 if previous is not None else 1
+            self._current = Generation(self, number, prepared)
+            stale = self._retire(previous)
+
+        for entry in stale:
+            _close(entry)
+        return number
+
+    @contextmanager
+    def pin(self):
+        """Yield the current generation, kept alive until the block is left."""
+        with self._lock:
+            generation = self._current
+            if generation is None:
+                raise EstimatorNotConfigured("PMU estimator is not configured")
+            generation._pinned += 1
+
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                generation._pinned -= 1
+                drained = generation._retired and generation._pinned == 0
+                stale = generation._take_entries() if drained else []
+            for entry in stale:
+                _close(entry)
+
+    @contextmanager
+    def acquire(self, key):
+        """Yield the estimator of key in the current generation with its lock held."""
+        with self.pin() as generation, generation.acquire(key) as synchestim:
+            yield synchestim
+
+    def close(self):
+        """Retire the current generation for good, its estimators are freed once its frames drain."""
+        with self._lock:
+            previous, self._current = self._current, None
+            stale = self._retire(previous)
+
+        for entry in stale:
+            _close(entry)
+
+    def clear(self):
+        # drop the estimators of the current generation, new frames get fresh ones
+        with self._lock:
+            stale = self._current._take_entries() if self._current is not None else []
+        for entry in stale:
+            _close(entry)
+
+    def evict_idle(self):
+        with self._lock:
+            evicted = self._current._collect_evicted(time.monotonic()) if self._current is not None else []
+        for entry in evicted:
+            _close(entry)
+
+    def __len__(self):
+        return len(self._current._entries) if self._current is not None else 0
+
+    @staticmethod
+    def _retire(generation):
+        # called with the registry lock held
+        if generation is None:
+            return []
+        generation._retired = True
+        return generation._take_entries() if generation._pinned == 0 else []
+
+
+def _close(entry):
+    with entry.lock:
+        if not entry.closed:
+            entry.closed = True
+            entry.estimator.deinit()
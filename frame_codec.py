@@ -0,0 +1,222 @@
+import base64
+import binascii
+import struct
+import numpy as np
+
+# samples travel as little-endian IEEE 754 doubles
+SAMPLE_DTYPE = np.dtype('<f8')
+
+# binary frames, all fields little-endian:
+#   header   SOC u32, FRACSEC u32, timebase u32, channel count u16, version u16
+#   channel  channel number u16, reserved u16, sample count u32, samples f64 * count
+# headers are multiples of 8 bytes so the samples stay aligned.
+BINARY_FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct('<IIIHH')
+CHANNEL_HEADER = struct.Struct('<HHI')
+
+# binary results: FRAME_HEADER followed by one record per channel, generation
+# is the configuration generation the frame was estimated with
+RESULT_DTYPE = np.dtype([
+    ('channel_number', '<u4'),
+    ('generation', '<u4'),
+    ('amplitude', '<f8'),
+    ('phase', '<f8'),
+    ('frequency', '<f8'),
+    ('rocof', '<f8')
+])
+
+# messages of the local transport (mininube-local-api.py): body length u32,
+# kind u16, status u16, then the body. Requests have status 0, responses carry
+# the kind of their request and an HTTP-like status; errors have a JSON body.
+LOCAL_MESSAGE = struct.Struct('<IHH')
+LOCAL_CONFIGURE = 1     # body: /configure document as JSON, response: JSON
+LOCAL_ESTIMATE = 2      # body: binary frame, response: binary result
+
+
+class FrameDecodeError(ValueError):
+    pass
+
+
+def window_size(n_cycles, sample_rate, nominal_freq):
+    # number of samples the estimator expects in one channel window
+    return n_cycles * sample_rate // nominal_freq
+
+
+def decode_base64(payload):
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise FrameDecodeError(f"payload is not valid base64: {e}")
+
+
+def to_samples(decoded_data, n_samples=None):
+    # view decoded payload bytes as a read-only float64 array, in place with
+    # numpy.frombuffer, no per-sample conversion or intermediate list
+    if len(decoded_data) % SAMPLE_DTYPE.itemsize != 0:
+        raise FrameDecodeError(f"payload length {len(decoded_data)} is not a multiple of {SAMPLE_DTYPE.itemsize} bytes")
+
+    samples = np.frombuffer(decoded_data, dtype=SAMPLE_DTYPE)
+
+    if n_samples is not None and samples.size != n_samples:
+        raise FrameDecodeError(f"payload holds {samples.size} samples, expected {n_samples}")
+
+    return samples
+
+
+def decode_channels(channels, n_samples=None):
+    """Decode the channels of a JSON data frame into (channel_number, samples) windows."""
+    return channel_windows(decode_channel_payloads(channels), n_samples)
+
+
+def decode_channel_payloads(channels):
+    # first half of decode_channels: base64 to (channel_number, bytes)
+    decoded = []
+    for channel in channels:
+        try:
+            # an integral float like 1.0 is a valid integer to the schema
+            decoded.append((int(channel['channel_number']), decode_base64(channel['payload'])))
+        except FrameDecodeError as e:
+            raise FrameDecodeError(f"channel {channel['channel_number']}: {e}")
+    return decoded
+
+
+def channel_windows(decoded, n_samples=None):
+    # second half of decode_channels: bytes to (channel_number, samples)
+    windows = []
+    for channel_number, decoded_data in decoded:
+        try:
+            windows.append((channel_number, to_samples(decoded_data, n_samples)))
+        except FrameDecodeError as e:
+            raise FrameDecodeError(f"channel {channel_number}: {e}")
+    return windows
+
+
+def mid_window_fracsec(fracsec, timebase):
+    if timebase != 0:
+        return fracsec / timebase
+    return 0
+
+
+def advance_timestamp(timestamp, periods, reporting_rate):
+    """Timestamp of the frame periods reporting intervals after timestamp."""
+    timebase = timestamp['timebase']
+    ticks = timestamp['SOC'] * timebase + timestamp['FRACSEC'] + periods * timebase // reporting_rate
+    return {"SOC": ticks // timebase, "FRACSEC": ticks % timebase, "timebase": timebase}
+
+
+def frame_index(timestamp, reporting_rate):
+    """Number of reporting intervals from the epoch to timestamp, rounded to the nearest one."""
+    timebase = timestamp['timebase']
+    if timebase == 0:
+        raise FrameDecodeError("frame timestamp has a zero timebase")
+    ticks = timestamp['SOC'] * timebase + timestamp['FRACSEC']
+    return (2 * ticks * reporting_rate + timebase) // (2 * timebase)
+
+
+def sliding_windows(samples, n_samples, step):
+    """View of the windows of a contiguous stream, one row per window, without copying.
+
+    Windows start every step samples, trailing samples that do not fill a
+    whole window are left out.
+    """
+    if samples.size < n_samples:
+        return np.empty((0, n_samples), dtype=samples.dtype)
+    return np.lib.stride_tricks.sliding_window_view(samples, n_samples)[::step]
+
+
+def decode_binary_frame(body, n_samples=None):
+    """Decode a binary frame into its timestamp and (channel_number, samples) windows.
+
+    The samples are float64 views into body, nothing is copied.
+    """
+    body = memoryview(body)
+    if len(body) < FRAME_HEADER.size:
+        raise FrameDecodeError(f"frame is shorter than its {FRAME_HEADER.size} byte header")
+
+    soc, fracsec, timebase, n_channels, version = FRAME_HEADER.unpack_from(body, 0)
+    if version != BINARY_FRAME_VERSION:
+        raise FrameDecodeError(f"unsupported binary frame version {version}")
+
+    offset = FRAME_HEADER.size
+    windows = []
+    for _ in range(n_channels):
+        if len(body) < offset + CHANNEL_HEADER.size:
+            raise FrameDecodeError("frame ends inside a channel header")
+        channel_number, _, count = CHANNEL_HEADER.unpack_from(body, offset)
+        offset += CHANNEL_HEADER.size
+
+        end = offset + count * SAMPLE_DTYPE.itemsize
+        if len(body) < end:
+            raise FrameDecodeError(f"channel {channel_number}: frame ends inside its samples")
+        if n_samples is not None and count != n_samples:
+            raise FrameDecodeError(f"channel {channel_number}: holds {count} samples, expected {n_samples}")
+
+        windows.append((channel_number, np.frombuffer(body[offset:end], dtype=SAMPLE_DTYPE)))
+        offset = end
+
+    if offset != len(body):
+        raise FrameDecodeError(f"{len(body) - offset} trailing bytes after the last channel")
+
+    timestamp = {"SOC": soc, "FRACSEC": fracsec, "timebase": timebase}
+    return timestamp, windows
+
+
+def decode_binary_matrix(body, n_samples):
+    """Decode a binary frame into its timestamp, channel numbers and (n_channels, n_samples) samples.
+
+    The samples are a strided view into body, every row one channel,
+    nothing is copied. All channels must hold n_samples samples.
+    """
+    timestamp, windows = decode_binary_frame(body, n_samples)
+    if not windows:
+        # the offset of the first row would lie past the end of body
+        return timestamp, [], np.empty((0, n_samples), dtype=SAMPLE_DTYPE)
+    row_stride = CHANNEL_HEADER.size + n_samples * SAMPLE_DTYPE.itemsize
+    samples = np.ndarray((len(windows), n_samples), dtype=SAMPLE_DTYPE, buffer=memoryview(body),
+                         offset=FRAME_HEADER.size + CHANNEL_HEADER.size, strides=(row_stride, SAMPLE_DTYPE.itemsize))
+    return timestamp, [channel_number for channel_number, _ in windows], samples
+
+
+_FAILED = (np.nan, np.nan, np.nan, np.nan)
+
+def result_records(channel_numbers, estimated_frames, generation=0):
+    """RESULT_DTYPE records of the estimated frames of a frame, the fields of failed (None) ones are NaN."""
+    # one tuple per record, converted by numpy in a single pass
+    return np.array([
+        (channel_number, generation) + ((estimated_frame['synchrophasor']['amplitude'], estimated_frame['synchrophasor']['phase'],
+                                         estimated_frame['frequency'], estimated_frame['rocof']) if estimated_frame is not None else _FAILED)
+        for channel_number, estimated_frame in zip(channel_numbers, estimated_frames)
+    ], dtype=RESULT_DTYPE)
+
+
+def encode_result_records(timestamp, records):
+    header = FRAME_HEADER.pack(int(timestamp['SOC']), int(timestamp['FRACSEC']), int(timestamp['timebase']), len(records), BINARY_FRAME_VERSION)
+    return header + records.tobytes()
+
+
+def encode_binary_result(timestamp, channel_numbers, estimated_frames, generation=0):
+    return encode_result_records(timestamp, result_records(channel_numbers, estimated_frames, generation))
+
+
+def encode_binary_frame(timestamp, windows):
+    """Encode a frame given as (channel_number, samples) windows, the inverse of decode_binary_frame."""
+    parts = [FRAME_HEADER.pack(timestamp['SOC'], timestamp['FRACSEC'], timestamp['timebase'], len(windows), BINARY_FRAME_VERSION)]
+    for channel_number, samples in windows:
+        samples = np.ascontiguousarray(samples, dtype=SAMPLE_DTYPE)
+        parts.append(CHANNEL_HEADER.pack(channel_number, 0, samples.size))
+        parts.append(samples.data)
+    return b"".join(parts)
+
+
+def decode_binary_result(body):
+    """Decode a binary result into its timestamp and RESULT_DTYPE records, a view into body."""
+    if len(body) < FRAME_HEADER.size:
+        raise FrameDecodeError(f"result is shorter than its {FRAME_HEADER.size} byte header")
+    soc, fracsec, timebase, n_channels, version = FRAME_HEADER.unpack_from(body, 0)
+    if version != BINARY_FRAME_VERSION:
+        raise FrameDecodeError(f"unsupported binary result version {version}")
+    if len(body) < FRAME_HEADER.size + n_channels * RESULT_DTYPE.itemsize:
+        raise FrameDecodeError("result ends inside its records")
+
+    records = np.frombuffer(body, dtype=RESULT_DTYPE, count=n_channels, offset=FRAME_HEADER.size)
+    return {"SOC": soc, "FRACSEC": fracsec, "timebase": timebase}, records
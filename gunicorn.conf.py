@@ -0,0 +1,49 @@
+# Production server: gunicorn -c gunicorn.conf.py wsgi:app
+import os
+from shared_configuration import SharedConfiguration
+
+bind = os.environ.get("MININUBE_BIND", "0.0.0.0:8080")
+
+# pre-forked workers, each with its own engine and estimators, serving
+# MININUBE_GUNICORN_THREADS requests at a time
+workers = int(os.environ.get("MININUBE_GUNICORN_WORKERS", 0)) or os.cpu_count() or 1
+worker_class = "gthread"
+threads = int(os.environ.get("MININUBE_GUNICORN_THREADS", 4))
+
+# a gateway keeps its connection, and with it its worker and estimator
+# state, for as long as it keeps sending. Longer than the 60 s idle timeout
+# of AWS load balancers, so they close first.
+keepalive = int(os.environ.get("MININUBE_KEEPALIVE", 75))
+backlog = 2048
+timeout = 30
+
+# recycling a worker would drop the filter state of its streams
+max_requests = 0
+
+# the flask app, the estimator library and the compiled schemas are loaded
+# once in the master, the engines are started per worker in post_fork
+preload_app = True
+os.environ["MININUBE_DEFER_ENGINE"] = "1"
+
+# created before forking, so that a /configure reaches every worker
+shared_configuration = SharedConfiguration(max_streams=int(os.environ.get("MININUBE_MAX_STREAMS", 512)))
+
+
+def when_ready(server):
+    import wsgi
+
+    # published before the workers start, so that they all run the boot
+    # stream under the same version and follow its later reconfigurations
+    if wsgi.mininube.boot_configuration is not None:
+        shared_configuration.publish(wsgi.mininube.boot_stream_id, wsgi.mininube.boot_configuration)
+
+
+def post_fork(server, worker):
+    import wsgi
+
+    wsgi.mininube.shared_configuration = shared_configuration
+    wsgi.mininube.start_engine()
+
+
+def on_exit(server):
+    shared_configuration.remove()
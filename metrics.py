@@ -0,0 +1,172 @@
+import threading
+import weakref
+from bisect import bisect_left
+from time import perf_counter
+
+# latency buckets in seconds, 10 us to 1 s
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005,
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0
+)
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, n_buckets):
+        self.counts = [0] * (n_buckets + 1)
+        self.sum = 0.0
+
+
+class _Shard:
+    # the metrics recorded by one thread, only that thread writes to it
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def merge(self, other):
+        # list() copies without giving the owning thread a chance to add keys
+        for key, histogram in list(other.histograms.items()):
+            mine = self.histograms.get(key)
+            if mine is None:
+                mine = self.histograms[key] = _Histogram(len(histogram.counts) - 1)
+            for i, count in enumerate(histogram.counts):
+                mine.counts[i] += count
+            mine.sum += histogram.sum
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, perf_counter() - self.start, self.labels)
+        return False
+
+
+class Metrics:
+    """Counters and histograms rendered in the Prometheus text format.
+
+    Every thread records into its own shard without taking a lock, shards are
+    only summed up when the metrics are rendered. The shard of a finished
+    thread is folded into a common one, so short-lived request threads do
+    not pile up. Labels are passed as a tuple of (name, value) pairs.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()
+        self._lock = threading.Lock()
+        self._help = {}
+        self._gauges = []
+
+    def describe(self, name, kind, help):
+        self._help[name] = (kind, help)
+
+    def gauge(self, name, help, read):
+        """Register a gauge whose value, or {labels: value} dict, read() returns at render time."""
+        self.describe(name, "gauge", help)
+        self._gauges.append((name, read))
+
+    def observe(self, name, value, labels=()):
+        histograms = self._shard().histograms
+        histogram = histograms.get((name, labels))
+        if histogram is None:
+            histogram = histograms[(name, labels)] = _Histogram(len(self.buckets))
+        histogram.counts[bisect_left(self.buckets, value)] += 1
+        histogram.sum += value
+
+    def time(self, name, labels=()):
+        return _Timer(self, name, labels)
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def remove(self, label):
+        """Forget every series carrying label, a (name, value) pair, e.g. of a dropped stream."""
+        with self._lock:
+            shards = [self._retired] + self._shards
+        for shard in shards:
+            for series in (shard.histograms, shard.counters):
+                for key in [key for key in list(series) if label in key[1]]:
+                    series.pop(key, None)
+
+    def value(self, name):
+        """Sum of the counter name over all labels."""
+        with self._lock:
+            shards = [self._retired] + self._shards
+            return sum(value for shard in shards for (counter, _), value in list(shard.counters.items()) if counter == name)
+
+    def render(self):
+        total = _Shard()
+        with self._lock:
+            total.merge(self._retired)
+            for shard in self._shards:
+                total.merge(shard)
+
+        families = {}
+        for (name, labels), histogram in total.histograms.items():
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+        for (name, labels), value in total.counters.items():
+            families.setdefault(name, []).append(f"{name}{_labels(labels)} {value}")
+
+        for name, read in self._gauges:
+            value = read()
+            values = value if isinstance(value, dict) else {(): value}
+            families.setdefault(name, []).extend(f"{name}{_labels(labels)} {v}" for labels, v in values.items())
+
+        output = []
+        for name in sorted(families):
+            kind, help = self._help.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {help}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(families[name])
+        return "\n".join(output) + "\n"
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            weakref.finalize(threading.current_thread(), self._retire, shard)
+            return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.remove(shard)
+            self._retired.merge(shard)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
@@ -0,0 +1,136 @@
+import json
+import os
+import signal
+import socketserver
+import sys
+from pmu_schemas import validate_configure_document, ValidationError
+from config_cache import ConfigCache
+from estimator_registry import EstimatorConfigError, EstimatorNotConfigured
+from estimation_engine import InProcessEngine
+from frame_codec import (LOCAL_MESSAGE, LOCAL_CONFIGURE, LOCAL_ESTIMATE, decode_binary_matrix, encode_result_records,
+                         mid_window_fracsec, FrameDecodeError)
+from request_errors import RequestError, answer
+
+# largest message accepted, a bigger length prefix closes the connection
+MAX_MESSAGE_SIZE = int(os.environ.get("MININUBE_LOCAL_MAX_MESSAGE", 64 * 1024 * 1024))
+
+# prepared configurations, shared by all connections
+config_cache = ConfigCache(max_size=int(os.environ.get("MININUBE_CONFIG_CACHE_SIZE", 32)), spares=int(os.environ.get("MININUBE_CONFIG_SPARES", 2)))
+
+
+class GatewayConnection(socketserver.BaseRequestHandler):
+    """One co-located gateway on the Unix socket.
+
+    Messages are read into a buffer that is reused for the whole connection,
+    and the samples of a frame are estimated in place, as a strided view of
+    that buffer: no JSON, no base64 and no copy of the samples. Every
+    connection keeps its own estimators and is served by its own thread,
+    answering its messages in order.
+    """
+
+    def setup(self):
+        self.engine = InProcessEngine()
+        self.window_size = None
+        self.buffer = bytearray(64 * 1024)
+        self.header = bytearray(LOCAL_MESSAGE.size)
+
+    def finish(self):
+        self.engine.close()
+
+    def handle(self):
+        while True:
+            if not self.receive(memoryview(self.header)):
+                break
+            length, kind, _ = LOCAL_MESSAGE.unpack(self.header)
+            if length > MAX_MESSAGE_SIZE:
+                self.send(kind, 413, json.dumps({"message": f"message larger than {MAX_MESSAGE_SIZE} bytes"}).encode())
+                break
+
+            if len(self.buffer) < length:
+                self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+            body = memoryview(self.buffer)[:length]
+            if not self.receive(body):
+                break
+
+            status, response = answer(lambda: self.dispatch(kind, body))
+            self.send(kind, status, response if isinstance(response, bytes) else json.dumps(response).encode())
+
+    def dispatch(self, kind, body):
+        if kind == LOCAL_CONFIGURE:
+            return self.configure(body)
+        if kind == LOCAL_ESTIMATE:
+            return self.estimate(body)
+        raise RequestError(400, f"unknown message kind {kind}")
+
+    def receive(self, view):
+        # fill view, False if the gateway closed the connection
+        received = 0
+        while received < len(view):
+            n = self.request.recv_into(view[received:])
+            if n == 0:
+                return False
+            received += n
+        return True
+
+    def send(self, kind, status, response):
+        self.request.sendall(LOCAL_MESSAGE.pack(len(response), kind, status) + response)
+
+    def configure(self, body):
+        try:
+            document = json.loads(bytes(body))
+        except ValueError:
+            raise RequestError(400, "configure message is not valid JSON")
+        try:
+            # the connection is one stream, the stream_id only names it
+            configuration, stream_id = validate_configure_document(document)
+        except ValidationError as e:
+            raise RequestError(400, e.message)
+
+        try:
+            prepared = config_cache.prepare(configuration)
+            generation = self.engine.configure(prepared)
+        except EstimatorConfigError as e:
+            raise RequestError(500, str(e))
+
+        self.window_size = prepared.window_size
+
+        response = {"status": "Successfully Configured PMU Estimator", "generation": generation}
+        if stream_id is not None:
+            response["stream_id"] = stream_id
+        return response
+
+    def estimate(self, body):
+        if self.window_size is None:
+            raise RequestError(500, "PMU estimator is not configured")
+
+        try:
+            timestamp, channel_numbers, samples = decode_binary_matrix(body, self.window_size)
+            generation, records = self.engine.estimate_array(None, channel_numbers, samples, mid_window_fracsec(timestamp['FRACSEC'], timestamp['timebase']))
+        except FrameDecodeError as e:
+            raise RequestError(400, str(e))
+        except EstimatorNotConfigured as e:
+            raise RequestError(500, str(e))
+
+        return encode_result_records(timestamp, records)
+
+
+class LocalServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+
+    path = os.environ.get("MININUBE_LOCAL_SOCKET", "/tmp/mininube.sock")
+    if os.path.exists(path):
+        os.unlink(path)
+
+    # unwind on SIGTERM too, so that the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with LocalServer(path, GatewayConnection) as server:
+        # only gateways of the same user, or group, may connect
+        os.chmod(path, int(os.environ.get("MININUBE_LOCAL_SOCKET_MODE", "660"), 8))
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
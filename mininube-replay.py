@@ -0,0 +1,296 @@
+import argparse
+import csv
+import json
+import os
+import struct
+import sys
+import time
+import numpy as np
+from pmu_schemas import validate_configure_document, ValidationError
+from config_cache import ConfigCache
+from estimation_engine import InProcessEngine, ProcessPoolEngine, parse_cpu_list
+from frame_codec import SAMPLE_DTYPE, advance_timestamp, mid_window_fracsec, sliding_windows
+
+
+class CaptureError(Exception):
+    pass
+
+
+class Capture:
+    """A recorded multi-channel waveform, memory-mapped rather than read.
+
+    samples is a read-only (n_samples, n_channels) array backed by the file,
+    only the stretch of it a chunk of frames needs is paged in and converted
+    to doubles.
+    """
+
+    def __init__(self, samples, sample_rate=None, scale=1.0, zero=0.0):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.scale = scale
+        self.zero = zero
+
+    @property
+    def n_samples(self):
+        return self.samples.shape[0]
+
+    @property
+    def n_channels(self):
+        return self.samples.shape[1]
+
+    def channel(self, index, start, stop):
+        """Samples start:stop of a channel as one contiguous array of doubles."""
+        samples = np.array(self.samples[start:stop, index], dtype=SAMPLE_DTYPE)
+        if self.zero:
+            samples -= self.zero
+        if self.scale != 1.0:
+            samples *= self.scale
+        return samples
+
+
+def open_raw(path, n_channels):
+    # interleaved little-endian doubles, sample after sample
+    n_samples = os.path.getsize(path) // (SAMPLE_DTYPE.itemsize * n_channels)
+    if n_samples == 0:
+        raise CaptureError(f"{path} holds less than one sample per channel")
+    return Capture(np.memmap(path, dtype=SAMPLE_DTYPE, mode="r", shape=(n_samples, n_channels)))
+
+
+def open_npy(path):
+    samples = np.load(path, mmap_mode="r")
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    if samples.ndim != 2:
+        raise CaptureError(f"{path} holds a {samples.ndim}-dimensional array, expected (samples, channels)")
+    return Capture(samples)
+
+
+# WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT and WAVE_FORMAT_EXTENSIBLE, whose
+# sub format starts with one of the other two
+WAV_PCM, WAV_FLOAT, WAV_EXTENSIBLE = 1, 3, 0xFFFE
+WAV_DTYPES = {(WAV_PCM, 8): "u1", (WAV_PCM, 16): "<i2", (WAV_PCM, 32): "<i4", (WAV_FLOAT, 32): "<f4", (WAV_FLOAT, 64): "<f8"}
+
+def open_wav(path):
+    # the wave module reads frames into memory, the data chunk is mapped instead
+    fmt = None
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise CaptureError(f"{path} is not a WAV file")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise CaptureError(f"{path} has no data chunk")
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                body = f.read(chunk_size)
+                fmt_tag, n_channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", body)
+                if fmt_tag == WAV_EXTENSIBLE:
+                    fmt_tag = struct.unpack_from("<H", body, 24)[0]
+                fmt = (fmt_tag, n_channels, sample_rate, bits)
+            elif chunk_id == b"data":
+                offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    if fmt is None:
+        raise CaptureError(f"{path} has no fmt chunk before its data")
+    fmt_tag, n_channels, sample_rate, bits = fmt
+    dtype = WAV_DTYPES.get((fmt_tag, bits))
+    if dtype is None:
+        raise CaptureError(f"{path}: unsupported sample format {fmt_tag} with {bits} bits")
+    dtype = np.dtype(dtype)
+
+    # the size field of streamed captures may be wrong, the file size is not
+    n_samples = min(chunk_size, os.path.getsize(path) - offset) // (dtype.itemsize * n_channels)
+    samples = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(n_samples, n_channels))
+
+    # integer PCM is scaled to [-1, 1), 8 bit PCM is unsigned
+    if dtype.kind in "iu":
+        return Capture(samples, sample_rate, scale=1.0 / 2 ** (bits - 1), zero=128.0 if dtype.kind == "u" else 0.0)
+    return Capture(samples, sample_rate)
+
+
+def open_capture(path, input_format=None, n_channels=None):
+    input_format = input_format or os.path.splitext(path)[1].lstrip(".").lower()
+    if input_format == "npy":
+        return open_npy(path)
+    if input_format == "wav":
+        return open_wav(path)
+    if n_channels is None:
+        raise CaptureError("raw captures need --channels")
+    return open_raw(path, n_channels)
+
+
+RESULT_COLUMNS = ["frame", "SOC", "FRACSEC", "timebase", "channel", "amplitude", "phase", "frequency", "rocof"]
+
+class CsvWriter:
+
+    def __init__(self, path):
+        self._file = open(path, "w", newline="") if path != "-" else sys.stdout
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(RESULT_COLUMNS)
+
+    def write(self, columns):
+        self._writer.writerows(zip(*(columns[name].tolist() for name in RESULT_COLUMNS)))
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+class ParquetWriter:
+
+    def __init__(self, path):
+        # pyarrow is only needed for parquet output, and slow to import
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise CaptureError("parquet output needs pyarrow")
+        self._pyarrow = pyarrow
+        self._path = path
+        self._writer = None
+
+    def write(self, columns):
+        # one row group per chunk of frames
+        table = self._pyarrow.table({name: columns[name] for name in RESULT_COLUMNS})
+        if self._writer is None:
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def open_writer(path, output_format=None):
+    output_format = output_format or ("parquet" if path.endswith(".parquet") else "csv")
+    return ParquetWriter(path) if output_format == "parquet" else CsvWriter(path)
+
+
+def replay(engine, prepared, capture, writer, start, reporting_rate, batch_frames=500):
+    """Estimate every frame of capture and hand the results to writer chunk by chunk.
+
+    Frames start every sample_rate / reporting_rate samples, the first one at
+    timestamp start. Every chunk of batch_frames frames is one estimate_batch
+    of the engine, so every channel runs through its windows in order.
+    Returns the number of frames and of channel estimates that failed.
+    """
+    window_size = prepared.window_size
+    step = prepared.sample_rate // reporting_rate
+    n_frames = max(0, (capture.n_samples - window_size) // step + 1)
+    channel_numbers = list(range(1, capture.n_channels + 1))
+
+    failed = 0
+    for first in range(0, n_frames, batch_frames):
+        count = min(batch_frames, n_frames - first)
+        start_sample = first * step
+        stop_sample = start_sample + (count - 1) * step + window_size
+
+        channel_windows = [
+            sliding_windows(capture.channel(index, start_sample, stop_sample), window_size, step)
+            for index in range(capture.n_channels)
+        ]
+        timestamps = [advance_timestamp(start, first + k, reporting_rate) for k in range(count)]
+        frames = [
+            ([(channel_number, windows[k]) for channel_number, windows in zip(channel_numbers, channel_windows)],
+             mid_window_fracsec(timestamp['FRACSEC'], timestamp['timebase']))
+            for k, timestamp in enumerate(timestamps)
+        ]
+
+        _, estimated_batch = engine.estimate_batch(None, frames)
+
+        # frame major, channel minor, like the frames themselves
+        n_rows = count * capture.n_channels
+        columns = {
+            "frame": np.repeat(np.arange(first, first + count), capture.n_channels),
+            "SOC": np.repeat([timestamp['SOC'] for timestamp in timestamps], capture.n_channels),
+            "FRACSEC": np.repeat([timestamp['FRACSEC'] for timestamp in timestamps], capture.n_channels),
+            "timebase": np.full(n_rows, start['timebase']),
+            "channel": np.tile(channel_numbers, count),
+        }
+        values = np.full((n_rows, 4), np.nan)
+        row = 0
+        for estimated_frames in estimated_batch:
+            for estimated_frame in estimated_frames:
+                if estimated_frame is None:
+                    failed += 1
+                else:
+                    values[row] = (estimated_frame['synchrophasor']['amplitude'], estimated_frame['synchrophasor']['phase'],
+                                   estimated_frame['frequency'], estimated_frame['rocof'])
+                row += 1
+        for i, name in enumerate(("amplitude", "phase", "frequency", "rocof")):
+            columns[name] = values[:, i]
+
+        writer.write(columns)
+
+    return n_frames, failed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run the estimators over a recorded waveform capture, without the REST API")
+    parser.add_argument("capture", help="raw interleaved little-endian float64 samples, a .npy array (samples, channels) or a .wav file")
+    parser.add_argument("configuration", help="JSON file with the /configure document to estimate with")
+    parser.add_argument("output", help="results as .csv (- for stdout) or .parquet")
+    parser.add_argument("--input-format", choices=["raw", "npy", "wav"], help="format of the capture, by default from its extension")
+    parser.add_argument("--output-format", choices=["csv", "parquet"], help="format of the output, by default from its extension")
+    parser.add_argument("--channels", type=int, help="number of interleaved channels of a raw capture")
+    parser.add_argument("--reporting-rate", type=int, help="frames per second, the configured frame_rate by default")
+    parser.add_argument("--soc", type=int, default=0, help="SOC of the first frame")
+    parser.add_argument("--fracsec", type=int, default=0, help="FRACSEC of the first frame")
+    parser.add_argument("--timebase", type=int, default=1000000, help="timebase of the timestamps")
+    parser.add_argument("--engine", choices=["inprocess", "process"], default="process",
+                        help="estimate in this process, or spread the channels over a pool of worker processes")
+    parser.add_argument("--workers", type=int, help="worker processes of the process engine, cpu count by default")
+    parser.add_argument("--cpu-affinity", default="", help="cpus the workers are pinned to, e.g. 0-3")
+    parser.add_argument("--batch-frames", type=int, default=500, help="frames estimated and written per chunk")
+    args = parser.parse_args()
+
+    with open(args.configuration) as f:
+        document = json.load(f)
+    try:
+        configuration, _ = validate_configure_document(document)
+    except ValidationError as e:
+        parser.error(f"{args.configuration}: {e.message}")
+
+    try:
+        capture = open_capture(args.capture, args.input_format, args.channels)
+    except CaptureError as e:
+        parser.error(str(e))
+
+    sample_rate = configuration['signal']['sample_rate']
+    reporting_rate = args.reporting_rate or configuration['synchrophasor']['frame_rate']
+    if capture.sample_rate is not None and capture.sample_rate != sample_rate:
+        parser.error(f"the capture is sampled at {capture.sample_rate} Hz, the configuration at {sample_rate} Hz")
+    if sample_rate % reporting_rate != 0:
+        parser.error(f"sample rate {sample_rate} is not a multiple of the reporting rate {reporting_rate}")
+
+    if args.engine == "process":
+        engine = ProcessPoolEngine(workers=args.workers, cpu_affinity=parse_cpu_list(args.cpu_affinity), spares=0,
+                                   max_channels=max(capture.n_channels, 1024))
+    else:
+        engine = InProcessEngine()
+    prepared = ConfigCache(max_size=1, spares=0).prepare(configuration)
+    engine.configure(prepared)
+
+    try:
+        writer = open_writer(args.output, args.output_format)
+    except CaptureError as e:
+        engine.close()
+        parser.error(str(e))
+
+    started = time.perf_counter()
+    try:
+        n_frames, failed = replay(engine, prepared, capture, writer,
+                                  {"SOC": args.soc, "FRACSEC": args.fracsec, "timebase": args.timebase},
+                                  reporting_rate, args.batch_frames)
+    finally:
+        writer.close()
+        engine.close()
+    elapsed = time.perf_counter() - started
+
+    print(f"{n_frames} frames of {capture.n_channels} channels in {elapsed:.1f} s "
+          f"({n_frames / elapsed if elapsed else 0:.0f} frames/s), {failed} failed estimates", file=sys.stderr)
+    sys.exit(1 if failed else 0)
@@ -1,58 +1,409 @@
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort, make_response, g
 from flask_restful import Api, Resource
-import json
-from jsonschema import validate, ValidationError
-from pmu_estimator import PMUEstimator, EstimatorConfig
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.middleware.proxy_fix import ProxyFix
+import os
+import atexit
 import base64
-import struct
+import json
+import numpy as np
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pmu_schemas import validate_configuration, validate_data_frame, validate_batch, validate_configure_document, VALIDATION_MODES, ValidationError
+from config_cache import ConfigCache
+from estimator_registry import EstimatorConfigError, EstimatorNotConfigured
+from estimation_engine import InProcessEngine, ProcessPoolEngine, EngineError, parse_cpu_list, EVICT_INTERVAL
+from stream_registry import StreamRegistry, UnknownStream
+from reorder_buffer import LateFrame, DuplicateFrame
+from sample_ring import SampleRing
+from admission_control import AdmissionControl, Rejected
+from metrics import Metrics
+from response_encoders import encode_json, encode_msgpack, encode_binary_frames, frame_result, frame_channel_numbers, JSON_MEDIATYPE, MSGPACK_MEDIATYPE, BINARY_MEDIATYPE
+from frame_codec import SAMPLE_DTYPE, decode_channels, decode_channel_payloads, channel_windows, decode_binary_matrix, encode_result_records, mid_window_fracsec, advance_timestamp, frame_index, sliding_windows, FrameDecodeError
 
 mininubePMU = Flask(__name__)
 api = Api(mininubePMU)
 
-# initialize pmu estimator object
-synchestim = PMUEstimator()
+# behind MININUBE_TRUSTED_PROXIES load balancers or reverse proxies, clients
+# are told apart by the address they add to X-Forwarded-For, not the proxy's
+TRUSTED_PROXIES = int(os.environ.get("MININUBE_TRUSTED_PROXIES", 0))
+if TRUSTED_PROXIES > 0:
+    mininubePMU.wsgi_app = ProxyFix(mininubePMU.wsgi_app, x_for=TRUSTED_PROXIES)
 
-class Configure(Resource):
+# the last MININUBE_CONFIG_CACHE_SIZE configurations stay prepared, each with
+# MININUBE_CONFIG_SPARES freshly configured estimators kept in stock
+CONFIG_CACHE_SIZE = int(os.environ.get("MININUBE_CONFIG_CACHE_SIZE", 32))
+CONFIG_SPARES = int(os.environ.get("MININUBE_CONFIG_SPARES", 2))
+
+# every /configure creates or reconfigures a stream with a configuration of
+# its own. At most MININUBE_MAX_STREAMS streams are kept, streams without a
+# frame for MININUBE_STREAM_TTL seconds are dropped, and every stream has
+# estimators for at most MININUBE_MAX_CHANNELS channels
+MAX_STREAMS = int(os.environ.get("MININUBE_MAX_STREAMS", 512))
+STREAM_TTL = float(os.environ.get("MININUBE_STREAM_TTL", 600))
+MAX_CHANNELS = int(os.environ.get("MININUBE_MAX_CHANNELS", 64))
+
+# MININUBE_REORDER_WINDOW > 0 runs the frames of a stream in timestamp order,
+# holding a frame back for up to that many milliseconds while an earlier one
+# is missing. Late and duplicate frames are refused with 409.
+REORDER_WINDOW = float(os.environ.get("MININUBE_REORDER_WINDOW", 0)) / 1000
+
+# at most MININUBE_MAX_CONCURRENT_ESTIMATES requests estimate at a time and
+# MININUBE_MAX_QUEUE wait for their turn, more are refused. With
+# MININUBE_FRAME_DEADLINE set, frames that cannot be estimated within that many
+# milliseconds of their timestamp are refused too, before any work is done
+MAX_CONCURRENT_ESTIMATES = int(os.environ.get("MININUBE_MAX_CONCURRENT_ESTIMATES", 0)) or os.cpu_count() or 1
+MAX_QUEUE = int(os.environ.get("MININUBE_MAX_QUEUE", 64))
+FRAME_DEADLINE = float(os.environ.get("MININUBE_FRAME_DEADLINE", 0)) / 1000
+
+# MININUBE_BOOT_CONFIGURATION, a /configure document or the path of a JSON file
+# holding one, configures a stream at startup; clients that configured no
+# stream of their own get a stream of their own with the same configuration.
+# Before the server reports ready on /ready, a synthetic frame of
+# MININUBE_WARMUP_CHANNELS channels runs through its estimators
+WARMUP_CHANNELS = min(int(os.environ.get("MININUBE_WARMUP_CHANNELS", 8)), MAX_CHANNELS)
+WARMUP_STREAM_ID = "__warmup__"
+
+def load_boot_configuration(value):
+    """The configuration and stream id of a boot /configure document, (None, None) without one."""
+    if not value:
+        return None, None
+    if value.lstrip().startswith("{"):
+        document = json.loads(value)
+    else:
+        with open(value) as f:
+            document = json.load(f)
+
+    return validate_configure_document(document, "default")
+
+boot_configuration, boot_stream_id = load_boot_configuration(os.environ.get("MININUBE_BOOT_CONFIGURATION", ""))
+
+# the engine, configuration cache and streams of this process
+engine = None
+config_cache = None
+streams = None
+
+# set by gunicorn.conf.py, the stream configurations shared by all gunicorn
+# workers, and the version of them this worker has applied
+shared_configuration = None
+configured_version = 0
+sync_lock = threading.Lock()
+
+# set once start_engine has configured and warmed up the boot stream
+ready = False
+boot_owner_lock = threading.Lock()
+
+def start_engine():
+    """Create the engine, configuration cache and streams of this process.
+
+    Called on import, or by gunicorn.conf.py in every worker after the fork.
+    Returns once the boot stream is configured and warmed up.
+    """
+    global engine, config_cache, streams, ready
+
+    # one pmu estimator object per (stream, channel), created on demand.
+    # MININUBE_ENGINE=process moves them to a pool of MININUBE_WORKERS worker
+    # processes, optionally pinned to the cpus in MININUBE_CPU_AFFINITY (e.g. "0-3")
+    if os.environ.get("MININUBE_ENGINE", "inprocess") == "process":
+        engine = ProcessPoolEngine(
+            workers = int(os.environ.get("MININUBE_WORKERS", 0)) or None,
+            cpu_affinity = parse_cpu_list(os.environ.get("MININUBE_CPU_AFFINITY", "")),
+            spares = CONFIG_SPARES,
+            max_channels = MAX_CHANNELS
+        )
+        # the estimators live in the workers, no spares needed here
+        config_cache = ConfigCache(max_size=CONFIG_CACHE_SIZE, spares=0)
+    else:
+        engine = InProcessEngine(max_channels=MAX_CHANNELS)
+        config_cache = ConfigCache(max_size=CONFIG_CACHE_SIZE, spares=CONFIG_SPARES)
+    streams = StreamRegistry(engine, max_streams=MAX_STREAMS, ttl=STREAM_TTL, reorder_window=REORDER_WINDOW,
+                             on_drop=forget_stream_metrics)
+    atexit.register(engine.close)
+    threading.Thread(target=evict_idle, daemon=True).start()
+
+    if shared_configuration is not None:
+        # the published streams, the boot stream among them, see gunicorn.conf.py
+        sync_configuration()
+    if boot_configuration is not None:
+        if boot_stream_id not in streams:
+            configure_stream(boot_configuration, boot_stream_id)
+        if WARMUP_CHANNELS > 0:
+            warm_up(streams.lookup(boot_stream_id).prepared)
+    ready = True
+
+def evict_idle():
+    # streams and estimators are evicted on lookups, idle ones are swept up here
+    while True:
+        time.sleep(EVICT_INTERVAL)
+        streams.evict_idle()
+        engine.evict_idle()
+
+def warm_up(prepared):
+    """Run a synthetic frame through the request path and the estimators of prepared.
+
+    The frame is estimated on a stream of its own that is dropped again, so
+    no real stream carries its filter state; what stays warm are the code
+    paths, the estimator library and, in process mode, the worker processes.
+    """
+    n_samples = prepared.window_size
+    signal = np.cos(2 * np.pi * prepared.configuration['signal']['nominal_freq'] * np.arange(n_samples) / prepared.sample_rate)
+    payload = base64.b64encode(signal.astype(SAMPLE_DTYPE).tobytes()).decode()
+    timestamp = {"SOC": 0, "FRACSEC": 0, "timebase": 1000000}
+    data_frame = {"timestamp": timestamp, "channels": [{"channel_number": n, "payload": payload} for n in range(1, WARMUP_CHANNELS + 1)]}
+
+    validate_data_frame(data_frame, VALIDATION_MODE)
+    windows = channel_windows(decode_channel_payloads(data_frame['channels']), n_samples)
+    engine.configure(prepared, None, WARMUP_STREAM_ID)
+    try:
+        _, estimated_frames = engine.estimate(WARMUP_STREAM_ID, windows, mid_window_fracsec(timestamp['FRACSEC'], timestamp['timebase']))
+        encode_json({"frame": frame_result(windows, estimated_frames), "generation": 0})
+    finally:
+        engine.drop(WARMUP_STREAM_ID)
+
+    # the first clients get their streams with the boot configuration, keep
+    # estimators for as many channels as the warm-up frame in stock for them
+    engine.stock(prepared, WARMUP_CHANNELS)
+
+admission = AdmissionControl(MAX_CONCURRENT_ESTIMATES, MAX_QUEUE)
+
+# MININUBE_VALIDATION=fast replaces the full json schema validation of data
+# frames with a structural check of the fields the estimator uses
+VALIDATION_MODE = os.environ.get("MININUBE_VALIDATION", "strict")
+if VALIDATION_MODE not in VALIDATION_MODES:
+    raise ValueError(f"MININUBE_VALIDATION must be one of {VALIDATION_MODES}")
+
+# per-thread, lock-free instrumentation served on /metrics
+metrics = Metrics()
+metrics.describe("mininube_stage_seconds", "histogram", "Latency of the request processing stages")
+metrics.describe("mininube_channel_frames_total", "counter", "Frames estimated per stream and channel")
+metrics.describe("mininube_errors_total", "counter", "Error responses per endpoint and status code")
+metrics.describe("mininube_frames_dropped_total", "counter", "Late and duplicate frames refused per stream")
+metrics.describe("mininube_frame_gaps_total", "counter", "Lost frames detected per stream, each one resets the stream's filters")
+metrics.describe("mininube_requests_started_total", "counter", "Requests accepted")
+metrics.describe("mininube_requests_finished_total", "counter", "Requests answered")
+metrics.gauge("mininube_requests_in_flight", "Requests accepted and not answered yet, the request queue depth",
+              lambda: metrics.value("mininube_requests_started_total") - metrics.value("mininube_requests_finished_total"))
+metrics.gauge("mininube_streams", "Configured streams", lambda: len(streams))
+metrics.describe("mininube_requests_shed_total", "counter", "Estimate requests refused by admission control, because the queue was full or the frame would be late")
+metrics.gauge("mininube_estimate_queue_depth", "Estimate requests waiting for a free estimation slot", lambda: admission.waiting)
+metrics.gauge("mininube_estimates_running", "Estimate requests holding an estimation slot", lambda: admission.running)
+metrics.gauge("mininube_config_cache", "Configuration cache size, hits and misses",
+              lambda: {(("value", name),): value for name, value in config_cache.stats().items()})
+
+STAGE_LABELS = {name: (("stage", name),) for name in (
+    "json_parse", "validation", "base64_decode", "sample_conversion", "binary_decode", "estimate", "serialization"
+)}
+
+def stage(name):
+    return metrics.time("mininube_stage_seconds", STAGE_LABELS[name])
+
+def forget_stream_metrics(stream_id):
+    # the stream labels come from clients, the series of dropped streams would pile up
+    metrics.remove(("stream", stream_id))
+
+def count_frames(stream_id, windows):
+    for channel_number, _ in windows:
+        metrics.inc("mininube_channel_frames_total", (("stream", stream_id), ("channel", channel_number)))
+
+@mininubePMU.before_request
+def request_started():
+    metrics.inc("mininube_requests_started_total")
+
+@mininubePMU.after_request
+def count_errors(response):
+    if response.status_code >= 400:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.inc("mininube_errors_total", (("endpoint", endpoint), ("code", response.status_code)))
+    return response
+
+@mininubePMU.after_request
+def fallback_content_type(response):
+    # flask_restful labels the response with the negotiated media type
+    mediatype = g.get("response_mediatype")
+    if mediatype is not None:
+        response.headers["Content-Type"] = mediatype
+    return response
+
+@mininubePMU.teardown_request
+def request_finished(exc):
+    metrics.inc("mininube_requests_finished_total")
+
+# responses are encoded in the format the Accept header asks for: JSON
+# (orjson when installed), msgpack when installed, or the binary result
+# records of /estimate/bin
+@api.representation(JSON_MEDIATYPE)
+def output_json(data, code, headers=None):
+    with stage("serialization"):
+        body = encode_json(data)
+    response = make_response(body, code)
+    response.headers["Content-Type"] = JSON_MEDIATYPE
+    response.headers.extend(headers or {})
+    return response
+
+if encode_msgpack is not None:
+    @api.representation(MSGPACK_MEDIATYPE)
+    def output_msgpack(data, code, headers=None):
+        with stage("serialization"):
+            body = encode_msgpack(data)
+        response = make_response(body, code)
+        response.headers["Content-Type"] = MSGPACK_MEDIATYPE
+        response.headers.extend(headers or {})
+        return response
 
-    configuration_schema = {
-        "type": "object",
-        "properties": {
-            "signal": {
-                "type": "object",
-                "properties": {
-                    "n_cycles": {"type": "integer"},
-                    "sample_rate": {"type": "integer"},
-                    "nominal_freq": {"type": "integer"}
-                },
-                "required": ["n_cycles", "sample_rate", "nominal_freq"]
-            },
-            "synchrophasor": {
-                "type": "object",
-                "properties": {
-                    "frame_rate": {"type": "integer"},
-                    "number_of_dft_bins": {"type": "integer"},
-                    "ipdft_iterations": {"type": "integer"},
-                    "iter_e_ipdft_enable": {"type": "integer"},
-                    "iter_e_ipdft_iterations": {"type": "integer"},
-                    "interference_threshold": {"type": "number"}
-                },
-                "required": ["frame_rate", "number_of_dft_bins", "ipdft_iterations", "iter_e_ipdft_enable", "iter_e_ipdft_iterations", "interference_threshold"]
-            },
-            "rocof": {
-                "type": "object",
-                "properties": {
-                    "threshold_1": {"type": "number"},
-                    "threshold_2": {"type": "number"},
-                    "threshold_3": {"type": "number"},
-                    "low_pass_filter_1": {"type": "number"},
-                    "low_pass_filter_2": {"type": "number"},
-                    "low_pass_filter_3": {"type": "number"}
-                },
-                "required": ["threshold_1", "threshold_2", "threshold_3", "low_pass_filter_1", "low_pass_filter_2", "low_pass_filter_3"]
-            }
-        },
-        "required": ["signal", "synchrophasor", "rocof"]
-    }
+@api.representation(BINARY_MEDIATYPE)
+def output_binary(data, code, headers=None):
+    with stage("serialization"):
+        body = encode_binary_frames(data, g.get("frame_timestamp"), g.get("channel_numbers")) if code < 400 else None
+    # errors and configure responses have no binary form
+    if body is None:
+        g.response_mediatype = JSON_MEDIATYPE
+        return output_json(data, code, headers)
+    response = make_response(body, code)
+    response.headers["Content-Type"] = BINARY_MEDIATYPE
+    response.headers.extend(headers or {})
+    return response
+
+def frame_due(timestamp):
+    # wall clock time by which the frame must be estimated, None if unchecked
+    if not FRAME_DEADLINE or not isinstance(timestamp, dict):
+        return None
+    try:
+        return timestamp['SOC'] + timestamp['FRACSEC'] / timestamp['timebase'] + FRAME_DEADLINE
+    except (KeyError, TypeError, ZeroDivisionError):
+        return None
+
+@contextmanager
+def shedding():
+    try:
+        yield
+    except Rejected as e:
+        metrics.inc("mininube_requests_shed_total", (("reason", e.reason),))
+        # 429 rather than 503, flask_restful logs a traceback for every 5xx
+        raise TooManyRequests(description=str(e), retry_after=e.retry_after)
+
+def admit(timestamp=None):
+    """Refuse the request before any work is done if the queue is full or its frame would be late."""
+    with shedding():
+        admission.check(frame_due(timestamp))
+
+@contextmanager
+def estimation_slot(timestamp=None, frames=1):
+    """Hold an estimation slot for the block, which may set slot["frames"] to the frames it estimated.
+
+    Taken inside frame_turn, so that a frame waiting for earlier frames of
+    its stream does not hold a slot those frames need.
+    """
+    with shedding():
+        admission.acquire(frame_due(timestamp))
+    slot = {"frames": frames}
+    started = time.perf_counter()
+    try:
+        yield slot
+    finally:
+        admission.release(time.perf_counter() - started, slot["frames"])
+
+def configure_stream(configuration, stream_id=None, owner=None, number=None):
+    return streams.configure(config_cache.prepare(configuration), stream_id, owner, number)
+
+@mininubePMU.before_request
+def sync_configuration():
+    # other gunicorn workers accepted a /configure since our last request
+    global configured_version
+
+    if shared_configuration is None or shared_configuration.version == configured_version:
+        return
+    with sync_lock:
+        if shared_configuration.version == configured_version:
+            return
+        published, version = shared_configuration.load()
+        for stream_id, entry in published.items():
+            if entry['version'] > configured_version and entry['version'] > streams.generation(stream_id):
+                configure_stream(entry['configuration'], stream_id, entry['owner'], entry['version'])
+        configured_version = version
+
+def restore_stream(stream_id, owner):
+    # a stream this worker evicted, while it stayed in use on other workers
+    published, _ = shared_configuration.load()
+    if stream_id is None:
+        owned = [published_id for published_id, entry in published.items() if entry['owner'] == owner]
+        stream_id = owned[-1] if owned else None
+
+    entry = published.get(stream_id)
+    if entry is None:
+        return None
+    return configure_stream(entry['configuration'], stream_id, entry['owner'], entry['version'])
+
+def lookup_stream(stream_id):
+    """The stream a request refers to, by its id or else the one its client configured last."""
+    try:
+        return streams.lookup(stream_id, request.remote_addr)
+    except UnknownStream as e:
+        stream = restore_stream(stream_id, request.remote_addr) if shared_configuration is not None else None
+        if stream is None and boot_configuration is not None:
+            if stream_id is None:
+                stream = boot_owner_stream(request.remote_addr)
+            elif stream_id == boot_stream_id:
+                # the boot stream was evicted, it comes back as it booted
+                stream = configure_stream(boot_configuration, boot_stream_id)
+        if stream is None:
+            abort(404, str(e))
+        return stream
+
+def boot_owner_stream(owner):
+    # a stream of the client's own with the boot configuration, so that
+    # gateways that never call /configure do not share filter state
+    with boot_owner_lock:
+        try:
+            return streams.lookup(None, owner)
+        except UnknownStream:
+            return configure_stream(boot_configuration, None, owner)
+
+@contextmanager
+def frame_turn(stream, timestamp):
+    """Run the block once all earlier frames of the stream have run, see REORDER_WINDOW."""
+    reorder = stream.reorder
+    if reorder is None:
+        yield
+        return
+
+    try:
+        gap = reorder.acquire(frame_index(timestamp, stream.prepared.frame_rate))
+    except (LateFrame, DuplicateFrame) as e:
+        reason = "late" if isinstance(e, LateFrame) else "duplicate"
+        metrics.inc("mininube_frames_dropped_total", (("stream", stream.stream_id), ("reason", reason)))
+        abort(409, str(e))
+    except FrameDecodeError as e:
+        abort(400, str(e))
+
+    try:
+        if gap:
+            # the filters would carry the state of frames that never came
+            metrics.inc("mininube_frame_gaps_total", (("stream", stream.stream_id),))
+            engine.reset(stream.stream_id)
+            # buffered samples would be spliced to the ones after the gap
+            for ring in stream.rings.values():
+                ring.clear()
+        yield
+    except TooManyRequests:
+        # the frame was shed before it ran, a retry must not be refused as a duplicate
+        reorder.release(ran=False)
+        raise
+    except BaseException:
+        reorder.release()
+        raise
+    else:
+        reorder.release()
+
+def check_channel_count(windows):
+    if len(windows) > MAX_CHANNELS:
+        abort(400, f"frame holds {len(windows)} channels, at most {MAX_CHANNELS} are allowed per stream")
+
+# upper bound on the frames of one /estimate/batch request
+MAX_BATCH_FRAMES = int(os.environ.get("MININUBE_MAX_BATCH_FRAMES", 10000))
+
+class Configure(Resource):
 
     def post(self):
         data = request.get_json()
@@ -63,99 +414,333 @@ class Configure(Resource):
         configuration = data['configuration']
 
         try:
-            validate(configuration, self.configuration_schema)
+            validate_configuration(configuration)
         except ValidationError as e:
             abort(400)
 
-        # process_configuration(configuration)
-        synchestim_config = EstimatorConfig(
-            n_cycles = configuration['signal']['n_cycles'],
-            fs = configuration['signal']['sample_rate'],
-            f0 = configuration['signal']['nominal_freq'],
-            frame_rate = configuration['synchrophasor']['frame_rate'],
-            n_bins = configuration['synchrophasor']['number_of_dft_bins'],
-            P = configuration['synchrophasor']['ipdft_iterations'],
-            iter_eipdft = configuration['synchrophasor']['iter_e_ipdft_enable'],
-            Q = configuration['synchrophasor']['iter_e_ipdft_iterations'],
-            interf_trig = configuration['synchrophasor']['interference_threshold'],
-            rocof_thresh = [configuration['rocof']['threshold_1'], configuration['rocof']['threshold_2'], configuration['rocof']['threshold_3']],
-            rocof_low_pass_coeffs= [configuration['rocof']['low_pass_filter_1'] , configuration['rocof']['low_pass_filter_2'], configuration['rocof']['low_pass_filter_3']]
-        )
-        synchestim.deinit()
-        if (synchestim.configure_from_class(synchestim_config) != 0):   
-            abort(500)
+        # reconfigures the given stream, or creates a new one
+        stream_id = data.get('stream_id')
+        if stream_id is not None and (not isinstance(stream_id, str) or not stream_id):
+            abort(400, "stream_id must be a non-empty string")
 
-        return {"status": "Successfully Configured PMU Estimator"}
+        owner = request.remote_addr
+
+        try:
+            if shared_configuration is None:
+                stream = configure_stream(configuration, stream_id, owner)
+            else:
+                # prepare first so a rejected configuration never reaches the other workers
+                config_cache.prepare(configuration)
+                stream_id = stream_id or uuid.uuid4().hex
+                with sync_lock:
+                    version = shared_configuration.publish(stream_id, configuration, owner)
+                    stream = configure_stream(configuration, stream_id, owner, version)
+        except EstimatorConfigError as e:
+            abort(500, str(e))
+
+        return {"status": "Successfully Configured PMU Estimator", "stream_id": stream.stream_id, "generation": stream.generation}
 
 class Estimate(Resource):
 
-    data_frame_schema = {
-        "type": "object",
-        "properties": {
-            "timestamp": { 
-                "type": "object",
-                "properties": {
-                    "SOC": {"type": "integer", "minimum": 0},
-                    "FRACSEC": {"type": "integer", "minimum": 0},
-                    "timebase": {"type": "integer", "minimum": 0}
-                },
-                "required": ["SOC", "FRACSEC", "timebase"]
-            },
-            "channels": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "channel_number": {"type": "integer"},
-                        "payload": {"type": "string"}
-                    },
-                    "required": ["channel_number", "payload"]
-                }
-            }
-        },
-        "required": ["timestamp", "channels"]
-    }
+    def post(self):
+        with stage("json_parse"):
+            data = request.get_json()
+
+        if not data or 'data_frame' not in data:
+            abort(400)
+
+        data_frame = data['data_frame']
+        admit(data_frame.get('timestamp') if isinstance(data_frame, dict) else None)
+
+        with stage("validation"):
+            try:
+                validate_data_frame(data_frame, VALIDATION_MODE)
+            except ValidationError as e:
+                print(e)
+                abort(400)
+        
+        stream = lookup_stream(data_frame.get('stream_id'))
+        stream_id = stream.stream_id
+
+        try:
+            with stage("base64_decode"):
+                decoded = decode_channel_payloads(data_frame['channels'])
+            with stage("sample_conversion"):
+                windows = channel_windows(decoded, stream.prepared.window_size)
+        except FrameDecodeError as e:
+            abort(400, str(e))
+
+        check_channel_count(windows)
+
+        try:
+            with frame_turn(stream, data_frame['timestamp']), estimation_slot(data_frame['timestamp']), stage("estimate"):
+                generation, estimated_frames = engine.estimate(stream_id, windows, mid_window_fracsec(data_frame['timestamp']['FRACSEC'], data_frame['timestamp']['timebase']))
+        except FrameDecodeError as e:
+            abort(400, str(e))
+        except (EstimatorNotConfigured, EngineError) as e:
+            abort(500, str(e))
+
+        count_frames(stream_id, windows)
+
+        frame = frame_result(windows, estimated_frames)
+        if frame is None:
+            abort(500)
+
+        # for the binary representation
+        g.frame_timestamp = data_frame['timestamp']
+        g.channel_numbers = frame_channel_numbers(windows)
+        return {"frame": frame, "generation": generation}
+
+class EstimateIncremental(Resource):
+    """Like Estimate, but the payloads only hold the samples new since the stream's previous frame.
+
+    The newest window_size samples of every channel are kept in a SampleRing
+    and estimated in place. Until every channel has a full window the frame
+    is answered with "frame": null and the number of samples buffered.
+    """
 
     def post(self):
-        data = request.get_json()
+        with stage("json_parse"):
+            data = request.get_json()
 
         if not data or 'data_frame' not in data:
             abort(400)
 
         data_frame = data['data_frame']
+        admit(data_frame.get('timestamp') if isinstance(data_frame, dict) else None)
+
+        with stage("validation"):
+            try:
+                validate_data_frame(data_frame, VALIDATION_MODE)
+            except ValidationError as e:
+                abort(400, e.message)
+
+        stream = lookup_stream(data_frame.get('stream_id'))
+        stream_id = stream.stream_id
 
         try:
-            validate(data_frame, self.data_frame_schema)
-        except ValidationError as e:
-            print(e)
+            with stage("base64_decode"):
+                decoded = decode_channel_payloads(data_frame['channels'])
+            with stage("sample_conversion"):
+                chunks = channel_windows(decoded)
+        except FrameDecodeError as e:
+            abort(400, str(e))
+
+        check_channel_count(chunks)
+
+        timestamp = g.frame_timestamp = data_frame['timestamp']
+        try:
+            # the slot is taken before the rings change, a chunk that is shed
+            # can be sent again
+            with frame_turn(stream, timestamp), estimation_slot(timestamp) as slot, stream.lock:
+                # samples before and after a lost or reordered chunk must not
+                # end up in one window, the rings start over instead
+                index = frame_index(timestamp, stream.prepared.frame_rate)
+                if stream.last_chunk is not None and index != stream.last_chunk + 1:
+                    for ring in stream.rings.values():
+                        ring.clear()
+                stream.last_chunk = index
+
+                rings = stream.rings
+                for channel_number, samples in chunks:
+                    ring = rings.get(channel_number)
+                    if ring is None:
+                        if len(rings) >= MAX_CHANNELS:
+                            abort(400, f"stream already buffers {MAX_CHANNELS} channels")
+                        ring = rings[channel_number] = SampleRing(stream.prepared.window_size)
+                    ring.append(samples)
+
+                if not all(rings[channel_number].full for channel_number, _ in chunks):
+                    # nothing estimated, the time spent must not count as estimating a frame
+                    slot["frames"] = 0
+                    buffered = min(rings[channel_number].filled for channel_number, _ in chunks)
+                    return {"frame": None, "generation": stream.generation, "buffered": buffered}
+
+                windows = [(channel_number, rings[channel_number].window()) for channel_number, _ in chunks]
+                with stage("estimate"):
+                    generation, estimated_frames = engine.estimate(stream_id, windows, mid_window_fracsec(timestamp['FRACSEC'], timestamp['timebase']))
+        except FrameDecodeError as e:
+            abort(400, str(e))
+        except (EstimatorNotConfigured, EngineError) as e:
+            abort(500, str(e))
+
+        count_frames(stream_id, windows)
+
+        frame = frame_result(windows, estimated_frames)
+        if frame is None:
+            abort(500)
+
+        g.channel_numbers = frame_channel_numbers(windows)
+        return {"frame": frame, "generation": generation}
+
+class EstimateBinary(Resource):
+
+    def post(self):
+        # the binary header has no room for a stream id, it comes in the query string
+        stream = lookup_stream(request.args.get('stream_id'))
+        stream_id = stream.stream_id
+
+        try:
+            with stage("binary_decode"):
+                timestamp, channel_numbers, samples = decode_binary_matrix(request.get_data(cache=False), stream.prepared.window_size)
+        except FrameDecodeError as e:
+            abort(400, str(e))
+
+        admit(timestamp)
+
+        check_channel_count(channel_numbers)
+
+        try:
+            with frame_turn(stream, timestamp), estimation_slot(timestamp), stage("estimate"):
+                generation, records = engine.estimate_array(stream_id, channel_numbers, samples, mid_window_fracsec(timestamp['FRACSEC'], timestamp['timebase']))
+        except FrameDecodeError as e:
+            abort(400, str(e))
+        except (EstimatorNotConfigured, EngineError) as e:
+            abort(500, str(e))
+
+        if np.isnan(records['amplitude']).any():
+            abort(500)
+
+        count_frames(stream_id, zip(channel_numbers, samples))
+
+        with stage("serialization"):
+            body = encode_result_records(timestamp, records)
+        return Response(body, mimetype="application/octet-stream")
+
+class EstimateBatch(Resource):
+
+    def post(self):
+        with stage("json_parse"):
+            data = request.get_json()
+
+        if not data or 'batch' not in data:
             abort(400)
-        
-        # getting the midwindow fracsec
-        timebase =data_frame['timestamp']['timebase']
-
-        if timebase != 0:
-            mid_window_fracsec = data_frame['timestamp']['FRACSEC']/timebase
-        else:
-            mid_window_fracsec = 0
-
-        frame = {}
-        for channel in data_frame['channels']:
-            decoded_data = base64.b64decode(channel['payload'])
-            input_signal_window = []
-            for i in range(0, len(decoded_data), 8):
-                sample = struct.unpack("d", decoded_data[i:i+8])[0]
-                input_signal_window.append(sample)    
-            estimated_frame = synchestim.estimate(input_signal_window, mid_window_fracsec)
-            if estimated_frame is None:
+
+        batch = data['batch']
+        # batches replay recorded frames, they have no deadline
+        admit()
+
+        with stage("validation"):
+            try:
+                validate_batch(batch, VALIDATION_MODE)
+            except ValidationError as e:
+                abort(400, e.message)
+
+        stream = lookup_stream(batch.get('stream_id'))
+        stream_id = stream.stream_id
+
+        try:
+            if 'data_frames' in batch:
+                timestamps, frames = self.split_data_frames(batch, stream_id, stream.prepared)
+            else:
+                timestamps, frames = self.split_stream(batch, stream.prepared)
+        except FrameDecodeError as e:
+            abort(400, str(e))
+
+        for windows, _ in frames:
+            check_channel_count(windows)
+
+        try:
+            with estimation_slot(frames=len(frames)), stage("estimate"):
+                generation, estimated_batch = engine.estimate_batch(stream_id, frames)
+        except FrameDecodeError as e:
+            abort(400, str(e))
+        except (EstimatorNotConfigured, EngineError) as e:
+            abort(500, str(e))
+
+        results = []
+        for timestamp, (windows, _), estimated_frames in zip(timestamps, frames, estimated_batch):
+            frame = frame_result(windows, estimated_frames)
+            if frame is None:
                 abort(500)
 
-            frame["channel_" + str(channel['channel_number'])] = estimated_frame
-        
-        return {"frame": frame}
+            results.append({"timestamp": timestamp, "frame": frame})
+            count_frames(stream_id, windows)
+
+        g.channel_numbers = {}
+        for windows, _ in frames:
+            g.channel_numbers.update(frame_channel_numbers(windows))
+        return {"frames": results, "generation": generation}
+
+    @staticmethod
+    def split_data_frames(batch, stream_id, prepared):
+        if len(batch['data_frames']) > MAX_BATCH_FRAMES:
+            abort(413, f"batch holds more than {MAX_BATCH_FRAMES} frames")
+
+        timestamps = []
+        frames = []
+        for data_frame in batch['data_frames']:
+            if data_frame.get('stream_id', stream_id) != stream_id:
+                abort(400, "all data frames of a batch must belong to the batch stream")
+
+            timestamp = data_frame['timestamp']
+            windows = decode_channels(data_frame['channels'], prepared.window_size)
+
+            timestamps.append(timestamp)
+            frames.append((windows, mid_window_fracsec(timestamp['FRACSEC'], timestamp['timebase'])))
+
+        return timestamps, frames
+
+    @staticmethod
+    def split_stream(batch, prepared):
+        # the timestamp is the one of the first window, every following
+        # window starts sample_rate / reporting_rate samples later
+        sample_rate = prepared.sample_rate
+        reporting_rate = batch.get('reporting_rate', prepared.frame_rate)
+
+        if sample_rate % reporting_rate != 0:
+            abort(400, f"sample rate {sample_rate} is not a multiple of the reporting rate {reporting_rate}")
+        if batch['timestamp']['timebase'] == 0:
+            abort(400, "a sample stream needs a non-zero timebase")
+
+        step = sample_rate // reporting_rate
+
+        channels = decode_channels(batch['channels'])
+        if len({samples.size for _, samples in channels}) > 1:
+            abort(400, "all channels of a sample stream must hold the same number of samples")
+
+        channel_windows = [(channel_number, sliding_windows(samples, prepared.window_size, step)) for channel_number, samples in channels]
+        n_frames = len(channel_windows[0][1]) if channel_windows else 0
+        if n_frames > MAX_BATCH_FRAMES:
+            abort(413, f"sample stream spans more than {MAX_BATCH_FRAMES} frames")
+
+        timestamps = []
+        frames = []
+        for k in range(n_frames):
+            timestamp = advance_timestamp(batch['timestamp'], k, reporting_rate)
+            windows = [(channel_number, windows[k]) for channel_number, windows in channel_windows]
+
+            timestamps.append(timestamp)
+            frames.append((windows, mid_window_fracsec(timestamp['FRACSEC'], timestamp['timebase'])))
+
+        return timestamps, frames
+
+class Ready(Resource):
+
+    def get(self):
+        if not ready:
+            # returned rather than aborted, flask_restful logs a traceback for every 5xx raised
+            return {"status": "starting"}, 503
+        return {"status": "ready", "streams": len(streams)}
+
+class PrometheusMetrics(Resource):
+
+    def get(self):
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 api.add_resource(Estimate, "/estimate")
+api.add_resource(EstimateBatch, "/estimate/batch")
+api.add_resource(EstimateIncremental, "/estimate/incremental")
+api.add_resource(EstimateBinary, "/estimate/bin")
 api.add_resource(Configure, "/configure")
+api.add_resource(PrometheusMetrics, "/metrics")
+api.add_resource(Ready, "/ready")
+
+# gunicorn.conf.py preloads this module in the master and starts the engines
+# in the workers instead
+if os.environ.get("MININUBE_DEFER_ENGINE") != "1":
+    start_engine()
 
 if __name__ == "__main__":
 
-    mininubePMU.run(debug=False, threaded=True, host='0.0.0.0', port=8080)
+    mininubePMU.run(debug=False, threaded=True, host='0.0.0.0', port=int(os.environ.get("MININUBE_PORT", 8080)))
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import websockets
+from pmu_schemas import validate_configuration, validate_data_frame, VALIDATION_MODES, ValidationError
+from config_cache import ConfigCache
+from estimator_registry import EstimatorConfigError, EstimatorNotConfigured
+from estimation_engine import InProcessEngine
+from frame_codec import decode_channels, mid_window_fracsec, FrameDecodeError
+from request_errors import RequestError, answer
+
+# messages read ahead per connection before we stop reading its socket
+PIPELINE_DEPTH = int(os.environ.get("MININUBE_WS_PIPELINE_DEPTH", 16))
+
+# "strict" or "fast" validation of data frames, see pmu_schemas
+VALIDATION_MODE = os.environ.get("MININUBE_VALIDATION", "strict")
+if VALIDATION_MODE not in VALIDATION_MODES:
+    raise ValueError(f"MININUBE_VALIDATION must be one of {VALIDATION_MODES}")
+
+# prepared configurations, shared by all connections
+config_cache = ConfigCache(max_size=int(os.environ.get("MININUBE_CONFIG_CACHE_SIZE", 32)), spares=int(os.environ.get("MININUBE_CONFIG_SPARES", 2)))
+
+# threads running the decoding and estimation, off the event loop
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get("MININUBE_WS_THREADS", 0)) or None)
+
+
+class GatewayConnection:
+    """State of one gateway connection.
+
+    Speaks the {"action": "configure" | "estimate"} protocol of
+    testers/WEBSOCKETS_API_TEST.py. Every connection has its own estimators,
+    so gateways never share filter state. Messages of a connection are
+    handled one after the other and answered in order, while the next ones
+    are already read into a bounded queue.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.engine = InProcessEngine()
+        self.n_samples = None
+        self.queue = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+
+    async def serve(self):
+        processor = asyncio.create_task(self.process())
+        try:
+            async for message in self.websocket:
+                # blocks once PIPELINE_DEPTH messages are pending, which
+                # stops reading and pushes back on the gateway through TCP
+                await self.queue.put(message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            await self.queue.put(None)
+            await processor
+            self.engine.close()
+
+    async def process(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                break
+
+            response = await loop.run_in_executor(executor, self.handle, message)
+            try:
+                await self.websocket.send(response)
+            except websockets.ConnectionClosed:
+                # drain the queue so the reader is never left blocked
+                while await self.queue.get() is not None:
+                    pass
+                break
+
+    def handle(self, message):
+        status, response = answer(lambda: self.dispatch(message))
+        if status != 200:
+            response = {"code": status, **response}
+        return json.dumps(response)
+
+    def dispatch(self, message):
+        try:
+            data = json.loads(message)
+        except ValueError:
+            raise RequestError(400, "message is not valid JSON")
+
+        if not isinstance(data, dict):
+            raise RequestError(400, "message is not a JSON object")
+
+        action = data.get("action")
+        if action == "configure" and "configuration" in data:
+            return self.configure(data["configuration"])
+        if action == "estimate" and "data_frame" in data:
+            return self.estimate(data["data_frame"])
+        raise RequestError(400, "unknown action")
+
+    def configure(self, configuration):
+        try:
+            validate_configuration(configuration)
+        except ValidationError as e:
+            raise RequestError(400, e.message)
+
+        try:
+            prepared = config_cache.prepare(configuration)
+            generation = self.engine.configure(prepared)
+        except EstimatorConfigError as e:
+            raise RequestError(500, str(e))
+
+        self.n_samples = prepared.window_size
+
+        return {"status": "Successfully Configured PMU Estimator", "generation": generation}
+
+    def estimate(self, data_frame):
+        try:
+            validate_data_frame(data_frame, VALIDATION_MODE)
+        except ValidationError as e:
+            raise RequestError(400, e.message)
+
+        try:
+            windows = decode_channels(data_frame['channels'], self.n_samples)
+        except FrameDecodeError as e:
+            raise RequestError(400, str(e))
+
+        timestamp = data_frame['timestamp']
+        try:
+            generation, estimated_frames = self.engine.estimate(data_frame.get('stream_id', ""), windows, mid_window_fracsec(timestamp['FRACSEC'], timestamp['timebase']))
+        except FrameDecodeError as e:
+            raise RequestError(400, str(e))
+        except EstimatorNotConfigured as e:
+            raise RequestError(500, str(e))
+
+        frame = {}
+        for (channel_number, _), estimated_frame in zip(windows, estimated_frames):
+            if estimated_frame is None:
+                raise RequestError(500, f"estimation failed on channel {channel_number}")
+
+            frame["channel_" + str(channel_number)] = estimated_frame
+
+        return {"frame": frame, "generation": generation}
+
+
+async def handler(websocket, path=None):
+    await GatewayConnection(websocket).serve()
+
+
+async def main(host, port):
+    async with websockets.serve(handler, host, port):
+        await asyncio.Future()
+
+
+if __name__ == "__main__":
+
+    asyncio.run(main(host='0.0.0.0', port=int(os.environ.get("MININUBE_WS_PORT", 8081))))
@@ -0,0 +1,439 @@
+import asyncio
+import json
+import random
+import socket
+import time
+from collections import deque
+from urllib.parse import urlsplit, urlencode
+import websockets
+from frame_codec import encode_binary_frame, decode_binary_result, LOCAL_MESSAGE, LOCAL_CONFIGURE, LOCAL_ESTIMATE
+
+# retried with backoff, the server is overloaded or restarting
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class ClientError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+def _dumps(document):
+    return json.dumps(document, separators=(",", ":")).encode()
+
+
+def _error_message(body):
+    try:
+        return json.loads(body)["message"]
+    except (ValueError, KeyError, TypeError):
+        return body.decode(errors="replace")
+
+
+def _fail(pending, error):
+    for _, future in pending:
+        if not future.done():
+            future.set_exception(error)
+
+
+def _frame_of_records(records):
+    # the {"channel_<n>": ...} frame of the JSON endpoints
+    return {
+        "channel_" + str(record['channel_number']): {
+            "synchrophasor": {"amplitude": float(record['amplitude']), "phase": float(record['phase'])},
+            "frequency": float(record['frequency']),
+            "rocof": float(record['rocof'])
+        }
+        for record in records
+    }
+
+
+class _Connection:
+    # one HTTP/1.1 keep-alive connection, one request at a time
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    async def request(self, head, body):
+        self.writer.write(head + body)
+        await self.writer.drain()
+
+        status_line, *header_lines = (await self.reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        version, status = status_line.split(" ", 2)[:2]
+        headers = {}
+        for line in header_lines:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self.reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                chunks.append(await self.reader.readexactly(size + 2))
+                if size == 0:
+                    break
+            content = b"".join(chunk[:-2] for chunk in chunks)
+        elif "content-length" in headers:
+            content = await self.reader.readexactly(int(headers["content-length"]))
+        else:
+            content = await self.reader.read()
+            self.reusable = False
+
+        if version == "HTTP/1.0" or headers.get("connection", "").lower() == "close":
+            self.reusable = False
+        return int(status), headers, content
+
+    def close(self):
+        self.writer.close()
+
+
+class MininubeClient:
+    """asyncio client of the REST API for node gateways.
+
+    Requests go over a pool of at most concurrency keep-alive connections,
+    so that many frames of a gateway are in flight at once without a TCP
+    handshake per frame. Requests answered with 429, 502, 503 or 504, or whose
+    connection failed, are retried up to max_retries times with exponential
+    backoff (or after the Retry-After the server asks for). A frame retried
+    after a lost connection may have been estimated already; with the
+    server's reorder window set, the repetition is refused as a duplicate.
+
+    on_latency(path, status, seconds) is called once per request, status is
+    None if it failed without an answer. With batch_size > 1, estimate()
+    collects up to batch_size frames for up to batch_delay seconds and sends
+    them as one /estimate/batch, one batch at a time, so frames still run in
+    order. If the server refuses a batch, its frames are sent one by one so
+    that only the frames at fault fail.
+
+    Behind gunicorn, the worker holding a stream's filters is the one its
+    connection reached, keep concurrency at 1 there unless the server shares
+    state between workers.
+    """
+
+    def __init__(self, url="http://127.0.0.1:8080", concurrency=8, max_retries=3, backoff=0.05, max_backoff=2.0,
+                 timeout=10.0, batch_size=1, batch_delay=0.005, on_latency=None):
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError("only http:// urls are supported")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.on_latency = on_latency
+        self.stream_id = None
+
+        self._slots = asyncio.Semaphore(concurrency)
+        self._idle = []
+        self._pending = []
+        self._flush_timer = None
+        self._batch_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.flush()
+        while self._idle:
+            self._idle.pop().close()
+
+    async def configure(self, configuration, stream_id=None):
+        """Configure the gateway's stream, a new one unless stream_id is given, and estimate on it from now on."""
+        document = {"configuration": configuration}
+        if stream_id is not None:
+            document["stream_id"] = stream_id
+        response = await self.post_json("/configure", document)
+        self.stream_id = response.get("stream_id")
+        return response
+
+    async def estimate(self, data_frame):
+        """Estimate a data frame and return {"frame", "generation"}."""
+        data_frame = self._with_stream(data_frame)
+        if self.batch_size <= 1:
+            return await self.post_json("/estimate", {"data_frame": data_frame})
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((data_frame, future))
+        if len(self._pending) >= self.batch_size:
+            self._schedule_flush(0)
+        elif self._flush_timer is None:
+            self._schedule_flush(self.batch_delay)
+        return await future
+
+    async def estimate_batch(self, data_frames):
+        """Estimate consecutive data frames in one request, returns {"frames", "generation"}."""
+        batch = {"data_frames": list(data_frames)}
+        if self.stream_id is not None:
+            batch["stream_id"] = self.stream_id
+        return await self.post_json("/estimate/batch", {"batch": batch})
+
+    async def estimate_binary(self, timestamp, windows):
+        """Estimate a frame given as (channel_number, samples) windows over /estimate/bin."""
+        params = {"stream_id": self.stream_id} if self.stream_id is not None else None
+        status, _, body = await self.request("/estimate/bin", encode_binary_frame(timestamp, windows),
+                                             "application/octet-stream", params=params)
+        if status != 200:
+            raise ClientError(status, _error_message(body))
+        _, records = decode_binary_result(body)
+        return {"frame": _frame_of_records(records), "generation": int(records['generation'][0]) if len(records) else None}
+
+    async def post_json(self, path, document):
+        status, _, body = await self.request(path, _dumps(document), "application/json")
+        if status != 200:
+            raise ClientError(status, _error_message(body))
+        return json.loads(body)
+
+    async def flush(self):
+        """Send the frames collected for a batch right away."""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        async with self._batch_lock:
+            for start in range(0, len(pending), self.batch_size):
+                await self._send_batch(pending[start:start + self.batch_size])
+
+    async def _send_batch(self, pending):
+        try:
+            response = await self.estimate_batch([data_frame for data_frame, _ in pending])
+        except ClientError as e:
+            # a batch is refused as a whole before any of its frames is
+            # estimated, one by one only the frames at fault fail
+            if len(pending) == 1 or not 400 <= e.status < 500 or e.status in RETRY_STATUSES:
+                _fail(pending, e)
+                return
+            for data_frame, future in pending:
+                try:
+                    result = await self.post_json("/estimate", {"data_frame": data_frame})
+                except Exception as e:
+                    _fail([(data_frame, future)], e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+            return
+        except Exception as e:
+            _fail(pending, e)
+            return
+
+        for (_, future), result in zip(pending, response["frames"]):
+            if not future.done():
+                future.set_result({"frame": result["frame"], "generation": response["generation"]})
+
+    async def request(self, path, body, content_type, accept="application/json", params=None):
+        """POST body to path and return status, headers and body, with retries."""
+        target = self.prefix + path + ("?" + urlencode(params) if params else "")
+        head = (f"POST {target} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nContent-Type: {content_type}\r\n"
+                f"Accept: {accept}\r\nContent-Length: {len(body)}\r\n\r\n").encode("latin-1")
+
+        started = time.perf_counter()
+        status = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                try:
+                    status, headers, content = await asyncio.wait_for(self._send(head, body), self.timeout)
+                except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+                    status = None
+                    if attempt == self.max_retries:
+                        raise
+                else:
+                    if status not in RETRY_STATUSES or attempt == self.max_retries:
+                        return status, headers, content
+                    retry_after = headers.get("retry-after")
+
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                if retry_after is not None and retry_after.isdigit():
+                    delay = float(retry_after)
+                await asyncio.sleep(delay)
+        finally:
+            if self.on_latency is not None:
+                self.on_latency(path, status, time.perf_counter() - started)
+
+    async def _send(self, head, body):
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                connection = _Connection(reader, writer)
+            try:
+                response = await connection.request(head, body)
+            except BaseException:
+                connection.close()
+                raise
+            if connection.reusable:
+                self._idle.append(connection)
+            else:
+                connection.close()
+            return response
+
+    def _schedule_flush(self, delay):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._flush_timer = loop.call_later(delay, lambda: loop.create_task(self.flush()))
+
+    def _with_stream(self, data_frame):
+        if self.stream_id is None or "stream_id" in data_frame:
+            return data_frame
+        return dict(data_frame, stream_id=self.stream_id)
+
+
+class MininubeWebSocketClient:
+    """asyncio client of mininube-ws-api.py, for gateways streaming over one WebSocket.
+
+    Up to depth messages are sent ahead without waiting for their answers,
+    which the server returns in order. If the connection drops, the next
+    request reconnects with exponential backoff and configures the new
+    connection like the old one; the requests in flight fail with
+    ConnectionError, and the new connection's filters start over.
+    """
+
+    def __init__(self, url="ws://127.0.0.1:8081", depth=16, max_retries=3, backoff=0.05, max_backoff=2.0, on_latency=None):
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_latency = on_latency
+
+        self._slots = asyncio.Semaphore(depth)
+        self._websocket = None
+        self._reader = None
+        self._in_flight = deque()
+        self._configuration = None
+        self._connect_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._websocket is not None:
+            await self._websocket.close()
+            await self._reader
+
+    async def configure(self, configuration):
+        response = await self._call({"action": "configure", "configuration": configuration})
+        self._configuration = configuration
+        return response
+
+    async def estimate(self, data_frame):
+        return await self._call({"action": "estimate", "data_frame": data_frame})
+
+    async def _call(self, message):
+        async with self._slots:
+            websocket = await self._connected()
+            future = asyncio.get_running_loop().create_future()
+            started = time.perf_counter()
+            self._in_flight.append(future)
+            await websocket.send(_dumps(message).decode())
+            response = await future
+            if self.on_latency is not None:
+                self.on_latency(message["action"], response.get("code", 200), time.perf_counter() - started)
+
+        if "code" in response:
+            raise ClientError(response["code"], response.get("message"))
+        return response
+
+    async def _connected(self):
+        async with self._connect_lock:
+            if self._websocket is not None and self._reader is not None and not self._reader.done():
+                return self._websocket
+
+            for attempt in range(self.max_retries + 1):
+                try:
+                    websocket = await websockets.connect(self.url)
+                    break
+                except OSError:
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+            if self._configuration is not None:
+                # filter state is per connection, the new one starts over
+                await websocket.send(_dumps({"action": "configure", "configuration": self._configuration}).decode())
+                response = json.loads(await websocket.recv())
+                if "code" in response:
+                    raise ClientError(response["code"], response.get("message"))
+
+            self._websocket = websocket
+            self._reader = asyncio.create_task(self._read(websocket))
+            return websocket
+
+    async def _read(self, websocket):
+        try:
+            async for message in websocket:
+                self._in_flight.popleft().set_result(json.loads(message))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            while self._in_flight:
+                future = self._in_flight.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError("connection to the server was lost"))
+
+
+class MininubeLocalClient:
+    """Blocking client of mininube-local-api.py, for gateways on the same host.
+
+    Frames go over a Unix socket as binary frames and come back as result
+    records, see frame_codec.LOCAL_MESSAGE. One request at a time per client.
+    """
+
+    def __init__(self, path="/tmp/mininube.sock"):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self._header = bytearray(LOCAL_MESSAGE.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def configure(self, configuration, stream_id=None):
+        document = {"configuration": configuration}
+        if stream_id is not None:
+            document["stream_id"] = stream_id
+        return json.loads(self._call(LOCAL_CONFIGURE, _dumps(document)))
+
+    def estimate(self, timestamp, windows):
+        """Estimate a frame given as (channel_number, samples) windows, returns the generation and RESULT_DTYPE records."""
+        _, records = decode_binary_result(self._call(LOCAL_ESTIMATE, encode_binary_frame(timestamp, windows)))
+        return (int(records['generation'][0]) if len(records) else None), records
+
+    def _call(self, kind, body):
+        self.sock.sendall(LOCAL_MESSAGE.pack(len(body), kind, 0) + body)
+        self._receive(memoryview(self._header))
+        length, _, status = LOCAL_MESSAGE.unpack(self._header)
+        response = bytearray(length)
+        self._receive(memoryview(response))
+        if status != 200:
+            raise ClientError(status, _error_message(bytes(response)))
+        return response
+
+    def _receive(self, view):
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError("the server closed the connection")
+            received += n
@@ -0,0 +1,221 @@
+import hashlib
+import json
+from jsonschema import validators, ValidationError
+from frame_codec import window_size
+
+# "strict" checks data frames against DATA_FRAME_SCHEMA, "fast" only checks
+# the fields the estimator relies on, by hand
+VALIDATION_MODES = ("strict", "fast")
+
+# channel numbers and timestamp fields are unsigned 32 bit integers in the
+# binary formats
+MAX_UINT32 = 2 ** 32 - 1
+
+CONFIGURATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "signal": {
+            "type": "object",
+            "properties": {
+                "n_cycles": {"type": "integer", "minimum": 1},
+                "sample_rate": {"type": "integer", "minimum": 1},
+                "nominal_freq": {"type": "integer", "minimum": 1}
+            },
+            "required": ["n_cycles", "sample_rate", "nominal_freq"]
+        },
+        "synchrophasor": {
+            "type": "object",
+            "properties": {
+                "frame_rate": {"type": "integer", "minimum": 1},
+                "number_of_dft_bins": {"type": "integer"},
+                "ipdft_iterations": {"type": "integer"},
+                "iter_e_ipdft_enable": {"type": "integer"},
+                "iter_e_ipdft_iterations": {"type": "integer"},
+                "interference_threshold": {"type": "number"}
+            },
+            "required": ["frame_rate", "number_of_dft_bins", "ipdft_iterations", "iter_e_ipdft_enable", "iter_e_ipdft_iterations", "interference_threshold"]
+        },
+        "rocof": {
+            "type": "object",
+            "properties": {
+                "threshold_1": {"type": "number"},
+                "threshold_2": {"type": "number"},
+                "threshold_3": {"type": "number"},
+                "low_pass_filter_1": {"type": "number"},
+                "low_pass_filter_2": {"type": "number"},
+                "low_pass_filter_3": {"type": "number"}
+            },
+            "required": ["threshold_1", "threshold_2", "threshold_3", "low_pass_filter_1", "low_pass_filter_2", "low_pass_filter_3"]
+        }
+    },
+    "required": ["signal", "synchrophasor", "rocof"]
+}
+
+DATA_FRAME_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "timestamp": { 
+            "type": "object",
+            "properties": {
+                "SOC": {"type": "integer", "minimum": 0, "maximum": MAX_UINT32},
+                "FRACSEC": {"type": "integer", "minimum": 0, "maximum": MAX_UINT32},
+                "timebase": {"type": "integer", "minimum": 0, "maximum": MAX_UINT32}
+            },
+            "required": ["SOC", "FRACSEC", "timebase"]
+        },
+        "stream_id": {"type": "string"},
+        "channels": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "channel_number": {"type": "integer", "minimum": 0, "maximum": MAX_UINT32},
+                    "payload": {"type": "string"}
+                },
+                "required": ["channel_number", "payload"]
+            }
+        }
+    },
+    "required": ["timestamp", "channels"]
+}
+
+# either an ordered list of data frames, or one contiguous stream of samples
+# per channel that is cut into windows at the reporting rate
+BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "stream_id": {"type": "string"},
+        "data_frames": {
+            "type": "array",
+            "items": {"type": "object"}
+        },
+        "timestamp": DATA_FRAME_SCHEMA["properties"]["timestamp"],
+        "reporting_rate": {"type": "integer", "minimum": 1},
+        "channels": DATA_FRAME_SCHEMA["properties"]["channels"]
+    },
+    "oneOf": [
+        {"required": ["data_frames"]},
+        {"required": ["timestamp", "channels"]}
+    ]
+}
+
+
+def _compile(schema):
+    # pick the validator class and check the schema once, not on every request
+    validator_class = validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
+CONFIGURATION_VALIDATOR = _compile(CONFIGURATION_SCHEMA)
+DATA_FRAME_VALIDATOR = _compile(DATA_FRAME_SCHEMA)
+BATCH_VALIDATOR = _compile(BATCH_SCHEMA)
+
+
+def _is_integer(value):
+    # same notion of integer as the json schema validator
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or isinstance(value, float) and value.is_integer()
+
+
+def check_data_frame(data_frame):
+    """Structural check of a data frame, a cheaper stand-in for DATA_FRAME_VALIDATOR.
+
+    Raises ValidationError on the first problem found.
+    """
+    if not isinstance(data_frame, dict):
+        raise ValidationError("data_frame is not an object")
+
+    timestamp = data_frame.get('timestamp')
+    if not isinstance(timestamp, dict):
+        raise ValidationError("timestamp is missing or not an object")
+    for field in ("SOC", "FRACSEC", "timebase"):
+        value = timestamp.get(field)
+        if not _is_integer(value) or not 0 <= value <= MAX_UINT32:
+            raise ValidationError(f"timestamp.{field} is missing or not an integer from 0 to {MAX_UINT32}")
+
+    if 'stream_id' in data_frame and not isinstance(data_frame['stream_id'], str):
+        raise ValidationError("stream_id is not a string")
+
+    channels = data_frame.get('channels')
+    if not isinstance(channels, list):
+        raise ValidationError("channels is missing or not an array")
+    for channel in channels:
+        if not isinstance(channel, dict) or not isinstance(channel.get('payload'), str):
+            raise ValidationError("channels entries need an integer channel_number and a string payload")
+        channel_number = channel.get('channel_number')
+        if not _is_integer(channel_number) or not 0 <= channel_number <= MAX_UINT32:
+            raise ValidationError(f"channel_number must be an integer from 0 to {MAX_UINT32}")
+
+
+def validate_configuration(configuration):
+    CONFIGURATION_VALIDATOR.validate(configuration)
+
+
+def validate_configure_document(document, default_stream_id=None):
+    """Validate a /configure document and return its configuration and stream_id."""
+    if not isinstance(document, dict) or 'configuration' not in document:
+        raise ValidationError("a /configure document needs a configuration")
+    stream_id = document.get('stream_id', default_stream_id)
+    if stream_id is not None and (not isinstance(stream_id, str) or not stream_id):
+        raise ValidationError("stream_id must be a non-empty string")
+    validate_configuration(document['configuration'])
+    return document['configuration'], stream_id
+
+
+def validate_data_frame(data_frame, mode="strict"):
+    if mode == "fast":
+        check_data_frame(data_frame)
+    else:
+        DATA_FRAME_VALIDATOR.validate(data_frame)
+
+
+def validate_batch(batch, mode="strict"):
+    BATCH_VALIDATOR.validate(batch)
+    for data_frame in batch.get('data_frames', []):
+        validate_data_frame(data_frame, mode)
+
+
+def estimator_config_kwargs(configuration):
+    # the EstimatorConfig arguments of a validated /configure document
+    return dict(
+        n_cycles = configuration['signal']['n_cycles'],
+        fs = configuration['signal']['sample_rate'],
+        f0 = configuration['signal']['nominal_freq'],
+        frame_rate = configuration['synchrophasor']['frame_rate'],
+        n_bins = configuration['synchrophasor']['number_of_dft_bins'],
+        P = configuration['synchrophasor']['ipdft_iterations'],
+        iter_eipdft = configuration['synchrophasor']['iter_e_ipdft_enable'],
+        Q = configuration['synchrophasor']['iter_e_ipdft_iterations'],
+        interf_trig = configuration['synchrophasor']['interference_threshold'],
+        rocof_thresh = [configuration['rocof']['threshold_1'], configuration['rocof']['threshold_2'], configuration['rocof']['threshold_3']],
+        rocof_low_pass_coeffs= [configuration['rocof']['low_pass_filter_1'] , configuration['rocof']['low_pass_filter_2'], configuration['rocof']['low_pass_filter_3']]
+    )
+
+
+def estimator_config(configuration):
+    # build the estimator configuration from a validated /configure document,
+    # imported here so the schemas can be used without the estimator library
+    from pmu_estimator import EstimatorConfig
+
+    return EstimatorConfig(**estimator_config_kwargs(configuration))
+
+
+def configuration_key(configuration):
+    """Canonical hash of the estimator configuration of a /configure document.
+
+    Documents that only differ in key order, or in 3 vs 3.0 for a real
+    valued field, get the same key.
+    """
+    kwargs = estimator_config_kwargs(configuration)
+    for name in ("interf_trig", "rocof_thresh", "rocof_low_pass_coeffs"):
+        value = kwargs[name]
+        kwargs[name] = [float(v) for v in value] if isinstance(value, list) else float(value)
+
+    canonical = json.dumps(kwargs, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def configuration_window_size(configuration):
+    return window_size(configuration['signal']['n_cycles'], configuration['signal']['sample_rate'], configuration['signal']['nominal_freq'])
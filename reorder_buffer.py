@@ -0,0 +1,81 @@
+import heapq
+import threading
+import time
+
+
+class LateFrame(Exception):
+    pass
+
+
+class DuplicateFrame(Exception):
+    pass
+
+
+class ReorderBuffer:
+    """Lets the frames of one stream through in timestamp order.
+
+    Frames are identified by their index, the timestamp counted in reporting
+    periods. A frame waits until every frame before it has run, or until it
+    has waited window seconds for a missing predecessor; the frames missing
+    by then are treated as lost and the frame is let through after a gap.
+    Only one frame of the stream runs at a time. Frames older than the last
+    one let through are late, frames already waiting or just let through are
+    duplicates; both are refused.
+
+    A frame more than max_jump periods before or after the last one, e.g.
+    after a bogus timestamp or a clock correction of the gateway, starts the
+    sequence over: it is let through right away as a gap instead of making
+    every following frame late.
+    """
+
+    def __init__(self, window, max_jump=3000):
+        self.window = window
+        self.max_jump = max_jump
+        self._pending = []
+        self._last = None
+        self._previous = None
+        self._busy = False
+        self._cond = threading.Condition()
+
+    def acquire(self, index):
+        """Wait for the turn of frame index and return whether frames before it were lost.
+
+        Every successful acquire must be followed by a release once the
+        frame has run.
+        """
+        with self._cond:
+            resync = self._last is not None and abs(index - self._last) > self.max_jump
+            if self._last is not None and index <= self._last and not resync:
+                if index == self._last:
+                    raise DuplicateFrame("a frame with this timestamp was already estimated")
+                raise LateFrame("frame arrived after a later frame of its stream was estimated")
+            if index in self._pending:
+                raise DuplicateFrame("a frame with this timestamp is already waiting")
+
+            heapq.heappush(self._pending, index)
+            deadline = time.monotonic() + self.window
+            while True:
+                if not self._busy and self._pending[0] == index:
+                    # the first frame of a stream waits too, earlier ones may still come
+                    in_order = self._last is not None and index == self._last + 1
+                    remaining = deadline - time.monotonic()
+                    if in_order or resync or remaining <= 0:
+                        break
+                else:
+                    remaining = max(deadline - time.monotonic(), 0)
+                # woken up by every frame that finishes, or to give up on a gap
+                self._cond.wait(remaining if remaining > 0 else None)
+
+            heapq.heappop(self._pending)
+            gap = resync or self._last is not None and index > self._last + 1
+            self._previous, self._last = self._last, index
+            self._busy = True
+            return gap
+
+    def release(self, ran=True):
+        """End the turn of the frame acquired last, with ran=False it may be sent again."""
+        with self._cond:
+            if not ran:
+                self._last = self._previous
+            self._busy = False
+            self._cond.notify_all()
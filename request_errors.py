@@ -0,0 +1,21 @@
+class RequestError(Exception):
+    """A request of a gateway connection that is answered with an HTTP-like error code."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def answer(handle):
+    """Call handle() and return (status, response), {"message": ...} if it failed.
+
+    Meant for connections that serve many messages: a failing message is
+    answered with an error instead of taking the connection down.
+    """
+    try:
+        return 200, handle()
+    except RequestError as e:
+        return e.code, {"message": str(e)}
+    except Exception as e:
+        # keep the connection alive, the next frame may well succeed
+        return 500, {"message": f"{type(e).__name__}: {e}"}
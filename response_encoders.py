@@ -0,0 +1,80 @@
+import json
+from functools import lru_cache
+from frame_codec import encode_binary_result
+
+# orjson and msgpack are optional, without orjson responses are encoded with
+# the json module, without msgpack application/msgpack is not offered
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MEDIATYPE = "application/json"
+MSGPACK_MEDIATYPE = "application/msgpack"
+BINARY_MEDIATYPE = "application/octet-stream"
+
+CHANNEL_PREFIX = "channel_"
+
+# "channel_<n>" keys, built once per channel number; the numbers come from
+# clients, so only the most recent ones are kept
+@lru_cache(maxsize=1024)
+def channel_key(channel_number):
+    return CHANNEL_PREFIX + str(channel_number)
+
+def frame_result(windows, estimated_frames):
+    """Return the {"channel_<n>": estimated_frame} dict of a frame, None if a channel failed."""
+    frame = {}
+    for (channel_number, _), estimated_frame in zip(windows, estimated_frames):
+        if estimated_frame is None:
+            return None
+        frame[channel_key(channel_number)] = estimated_frame
+    return frame
+
+def _builtin(value):
+    # numpy scalars the estimators may return
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+if orjson is not None:
+    def encode_json(data):
+        return orjson.dumps(data, default=_builtin, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+else:
+    _json_encoder = json.JSONEncoder(separators=(",", ":"), default=_builtin)
+
+    def encode_json(data):
+        return (_json_encoder.encode(data) + "\n").encode()
+
+if msgpack is not None:
+    def encode_msgpack(data):
+        return msgpack.packb(data, default=_builtin, use_bin_type=True)
+else:
+    encode_msgpack = None
+
+def frame_channel_numbers(windows):
+    """The {"channel_<n>": n} keys of the frames of windows, to encode their results in binary."""
+    return {channel_key(channel_number): channel_number for channel_number, _ in windows}
+
+def encode_binary_frames(data, timestamp=None, numbers=None):
+    """Encode an estimate response in the /estimate/bin result format, None if it holds no frames.
+
+    A single frame ({"frame", "generation"}) needs the timestamp of its
+    data frame, the frames of a batch carry their own and are concatenated.
+    numbers maps the frame keys back to channel numbers, see frame_channel_numbers.
+    A frame still being buffered is encoded without channel records.
+    """
+    numbers = numbers or {}
+    if "frames" in data:
+        return b"".join(
+            encode_binary_result(result["timestamp"], [numbers[key] for key in result["frame"]], result["frame"].values(), data["generation"])
+            for result in data["frames"]
+        )
+    if "frame" in data and timestamp is not None:
+        frame = data["frame"] or {}
+        return encode_binary_result(timestamp, [numbers[key] for key in frame], frame.values(), data["generation"])
+    return None
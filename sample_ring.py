@@ -0,0 +1,49 @@
+import numpy as np
+from frame_codec import SAMPLE_DTYPE
+
+
+class SampleRing:
+    """The newest size samples of a channel, readable as one window without copying.
+
+    Every sample is stored twice, at i and at i + size of a buffer of
+    2 * size samples, so the newest size samples always form the contiguous
+    slice [head:head + size], oldest first.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.filled = 0
+        self._buffer = np.zeros(2 * size, dtype=SAMPLE_DTYPE)
+        self._head = 0
+
+    @property
+    def full(self):
+        return self.filled == self.size
+
+    def append(self, samples):
+        size = self.size
+        if len(samples) > size:
+            samples = samples[-size:]
+        n = len(samples)
+
+        # the n oldest samples are overwritten, in both copies
+        head = self._head
+        first = min(n, size - head)
+        self._buffer[head:head + first] = samples[:first]
+        self._buffer[head + size:head + size + first] = samples[:first]
+        rest = n - first
+        if rest:
+            self._buffer[:rest] = samples[first:]
+            self._buffer[size:size + rest] = samples[first:]
+
+        self._head = (head + n) % size
+        self.filled = min(self.filled + n, size)
+
+    def window(self):
+        """Read-only view of the newest size samples, valid until the next append."""
+        view = self._buffer[self._head:self._head + self.size]
+        view.flags.writeable = False
+        return view
+
+    def clear(self):
+        self.filled = 0
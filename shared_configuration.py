@@ -0,0 +1,62 @@
+import json
+import multiprocessing
+import os
+import tempfile
+
+
+class SharedConfiguration:
+    """The stream configurations, shared by pre-forked server workers.
+
+    Created in the parent before forking. The worker that accepts a
+    /configure publishes the stream's document, which bumps the shared
+    version; every other worker sees the new version on its next request and
+    configures its own engine with the streams published since the version
+    it last saw. Reading the version is a plain shared memory read, so
+    checking it on every request is cheap. Only the max_streams most
+    recently published streams are kept.
+    """
+
+    def __init__(self, directory=None, max_streams=512):
+        fd, self.path = tempfile.mkstemp(prefix="mininube-configuration-", suffix=".json", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump({}, f)
+        self.max_streams = max_streams
+        self._version = multiprocessing.RawValue("Q", 0)
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def version(self):
+        return self._version.value
+
+    def publish(self, stream_id, configuration, owner=None):
+        """Store the configuration of stream_id for all workers and return its version."""
+        with self._lock:
+            streams = self._read()
+            version = self._version.value + 1
+            streams.pop(stream_id, None)
+            streams[stream_id] = {"version": version, "owner": owner, "configuration": configuration}
+            # the dict keeps publication order, the oldest streams go first
+            for stale in list(streams)[:max(0, len(streams) - self.max_streams)]:
+                del streams[stale]
+
+            staged = self.path + ".tmp"
+            with open(staged, "w") as f:
+                json.dump(streams, f)
+            os.replace(staged, self.path)
+            self._version.value = version
+            return version
+
+    def load(self):
+        """Return {stream_id: {"version", "owner", "configuration"}} and the current version."""
+        with self._lock:
+            return self._read(), self._version.value
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _read(self):
+        with open(self.path) as f:
+            return json.load(f)
@@ -0,0 +1,144 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from reorder_buffer import ReorderBuffer
+
+
+class UnknownStream(Exception):
+    pass
+
+
+class Stream:
+    __slots__ = ("stream_id", "prepared", "generation", "owner", "last_used", "reorder", "rings", "last_chunk", "lock", "configure_lock")
+
+    def __init__(self, stream_id, owner):
+        self.stream_id = stream_id
+        self.owner = owner
+        self.prepared = None
+        self.generation = 0
+        self.last_used = time.monotonic()
+        self.reorder = None
+        # SampleRing per channel of the incremental mode and the frame index
+        # of the last chunk appended to them, guarded by lock
+        self.rings = {}
+        self.last_chunk = None
+        self.lock = threading.Lock()
+        # one configure at a time, so prepared is the one the engine runs
+        self.configure_lock = threading.Lock()
+
+
+class StreamRegistry:
+    """The streams of the gateways, each with a configuration of its own.
+
+    A stream is created by a /configure and referenced by its id on every
+    estimate; clients that send no id get the stream they configured last
+    (their owner key, e.g. the client address). The configurations and
+    estimators live in the engine, which is told to drop a stream when it is
+    evicted: after ttl seconds without a frame, or as the least recently
+    used one beyond max_streams. Lookups are dictionary lookups.
+
+    on_drop(stream_id) is called for every evicted stream, after the engine
+    dropped it.
+
+    With a reorder_window, every stream gets a ReorderBuffer that holds its
+    frames back for up to that many seconds to run them in timestamp order.
+    """
+
+    def __init__(self, engine, max_streams=512, ttl=600.0, reorder_window=0.0, on_drop=None):
+        self.engine = engine
+        self.max_streams = max_streams
+        self.ttl = ttl
+        self.reorder_window = reorder_window
+        self.on_drop = on_drop
+        self._streams = OrderedDict()
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def configure(self, prepared, stream_id=None, owner=None, number=None):
+        """Configure stream_id, or a new stream if None, and return the stream."""
+        with self._lock:
+            if stream_id is None:
+                stream_id = uuid.uuid4().hex
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                stream = self._streams[stream_id] = Stream(stream_id, owner)
+            if owner is not None:
+                stream.owner = owner
+                self._owners[owner] = stream_id
+            evicted = self._touch(stream)
+
+        self._drop(evicted)
+
+        with stream.configure_lock:
+            stream.generation = self.engine.configure(prepared, number, stream_id)
+            # frame indices count reporting periods of the new configuration
+            # a jump of more than a minute of frames starts the sequence over
+            stream.reorder = ReorderBuffer(self.reorder_window, 60 * prepared.frame_rate) if self.reorder_window else None
+            stream.rings = {}
+            stream.last_chunk = None
+            stream.prepared = prepared
+
+        # evicted while the engine was being configured
+        if stream_id not in self._streams:
+            self.engine.drop(stream_id)
+        return stream
+
+    def lookup(self, stream_id=None, owner=None):
+        """Return the stream stream_id, or the one owner configured last if None."""
+        with self._lock:
+            if stream_id is None:
+                stream_id = self._owners.get(owner)
+                if stream_id is None:
+                    raise UnknownStream("no stream configured by this client, call /configure first")
+            stream = self._streams.get(stream_id)
+            if stream is None or stream.prepared is None:
+                raise UnknownStream(f"unknown stream {stream_id}")
+            evicted = self._touch(stream)
+
+        self._drop(evicted)
+        return stream
+
+    def generation(self, stream_id):
+        """Return the generation stream_id runs, 0 if it is unknown."""
+        stream = self._streams.get(stream_id)
+        return stream.generation if stream is not None else 0
+
+    def evict_idle(self):
+        with self._lock:
+            evicted = self._collect_evicted(time.monotonic())
+        self._drop(evicted)
+
+    def __contains__(self, stream_id):
+        return stream_id in self._streams
+
+    def __len__(self):
+        return len(self._streams)
+
+    def _touch(self, stream):
+        # called with the lock held
+        now = time.monotonic()
+        stream.last_used = now
+        self._streams.move_to_end(stream.stream_id)
+        return self._collect_evicted(now, keep=stream.stream_id)
+
+    def _collect_evicted(self, now, keep=None):
+        # streams are kept in least recently used order
+        evicted = []
+        while self._streams:
+            stream_id, stream = next(iter(self._streams.items()))
+            if stream_id == keep:
+                break
+            if len(self._streams) <= self.max_streams and now - stream.last_used < self.ttl:
+                break
+            del self._streams[stream_id]
+            if self._owners.get(stream.owner) == stream_id:
+                del self._owners[stream.owner]
+            evicted.append(stream)
+        return evicted
+
+    def _drop(self, evicted):
+        for stream in evicted:
+            self.engine.drop(stream.stream_id)
+            if self.on_drop is not None:
+                self.on_drop(stream.stream_id)
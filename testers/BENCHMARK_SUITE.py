@@ -0,0 +1,318 @@
+import argparse, itertools, json, os, platform, socket, subprocess, sys, threading, time
+import http.client
+import numpy as np
+from signal_generator import Scenario
+
+# the server scripts and their modules live one directory up
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+
+def get_configuration(sample_rate, n_cycles, nominal_freq = 50, frame_rate = 50):
+    return {
+        "signal": {
+            "n_cycles": n_cycles,
+            "sample_rate": sample_rate,
+            "nominal_freq": nominal_freq
+        },
+        "synchrophasor": {
+            "frame_rate": frame_rate,
+            "number_of_dft_bins": 11,
+            "ipdft_iterations": 3,
+            "iter_e_ipdft_enable": 1,
+            "iter_e_ipdft_iterations": 10,
+            "interference_threshold": 0.0033
+        },
+        "rocof": {
+            "threshold_1": 3,
+            "threshold_2": 25,
+            "threshold_3": 0.035,
+            "low_pass_filter_1": 0.5913,
+            "low_pass_filter_2": 0.2043,
+            "low_pass_filter_3": 0.2043
+        }
+    }
+
+
+def get_bodies(num_channels, sample_rate, n_cycles, nominal_freq = 50, frame_rate = 50):
+    # one second of three phase, off-nominal /estimate request bodies
+    scenario = Scenario(num_channels, sample_rate, n_cycles, nominal_freq, frame_rate, frequency=nominal_freq + 0.5, phase_step=-2 * np.pi / 3)
+    return [scenario.request_body(i, frame_rate) for i in range(frame_rate)]
+
+
+class InProcessTarget:
+    """Runs the /estimate request path in this process, without HTTP."""
+
+    name = "inprocess"
+
+    def __init__(self, validation = "strict"):
+        from config_cache import ConfigCache
+        from estimation_engine import InProcessEngine
+
+        self.validation = validation
+        self.config_cache = ConfigCache()
+        self.engine = InProcessEngine()
+        self.n_samples = None
+
+    def configure(self, configuration):
+        from pmu_schemas import validate_configuration
+
+        validate_configuration(configuration)
+        prepared = self.config_cache.prepare(configuration)
+        self.engine.configure(prepared)
+        self.n_samples = prepared.window_size
+
+    def connect(self):
+        from pmu_schemas import validate_data_frame
+        from frame_codec import decode_channels, mid_window_fracsec
+
+        stream_id = f"bench-{threading.get_ident()}"
+
+        def send(body):
+            data_frame = json.loads(body)["data_frame"]
+            validate_data_frame(data_frame, self.validation)
+            windows = decode_channels(data_frame["channels"], self.n_samples)
+            timestamp = data_frame["timestamp"]
+            generation, estimated_frames = self.engine.estimate(stream_id, windows, mid_window_fracsec(timestamp["FRACSEC"], timestamp["timebase"]))
+            json.dumps({"frame": {"channel_" + str(n): f for (n, _), f in zip(windows, estimated_frames)}, "generation": generation})
+
+        return send
+
+    def close(self):
+        self.engine.close()
+
+
+class ServerTarget:
+    """Sends the frames to a mininube REST server over HTTP.
+
+    Without a url, the server is started on a free local port and stopped
+    again by close(), either the development server of mininube-rest-api.py
+    or gunicorn with gunicorn.conf.py. The MININUBE_* environment is passed
+    through.
+    """
+
+    name = "server"
+
+    def __init__(self, url = None, server = "flask", startup_timeout = 30.0):
+        self.process = None
+        if url is None:
+            port = self.free_port()
+            if server == "gunicorn":
+                command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"]
+            else:
+                command = [sys.executable, "mininube-rest-api.py"]
+            self.process = subprocess.Popen(
+                command,
+                cwd = ROOT,
+                env = dict(os.environ, MININUBE_PORT=str(port), MININUBE_BIND=f"127.0.0.1:{port}"),
+                stdout = subprocess.DEVNULL,
+                stderr = subprocess.DEVNULL
+            )
+            url = f"http://127.0.0.1:{port}"
+        self.host, self.port = url.split("://", 1)[1].rstrip("/").split(":")
+        self.wait_ready(startup_timeout)
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    def wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.process is not None and self.process.poll() is not None:
+                raise RuntimeError("mininube-rest-api.py exited during startup")
+            try:
+                self.request("GET", "/metrics")
+                return
+            except (OSError, http.client.HTTPException):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def request(self, method, path, body = None, connection = None):
+        connection = connection or http.client.HTTPConnection(self.host, int(self.port), timeout=30)
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{method} {path}: {response.status} {data[:200]!r}")
+        return data
+
+    def configure(self, configuration):
+        self.request("POST", "/configure", json.dumps({"configuration": configuration}))
+
+    def connect(self):
+        # one keep-alive connection per sender thread
+        connection = http.client.HTTPConnection(self.host, int(self.port), timeout=30)
+        return lambda body: self.request("POST", "/estimate", body, connection)
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def run_open_loop(target, bodies, rate, concurrency, duration):
+    """Send frames at a fixed rate and return the latencies of the answered ones and the error count.
+
+    Frame i is due at start + i / rate whatever happened to the frames
+    before it, and its latency is measured from that due time. A server that
+    stalls therefore shows up in the latencies of every frame it held back,
+    instead of silently slowing down the load generator.
+    """
+    n_frames = max(1, int(rate * duration))
+    latencies = np.full(n_frames, np.nan)
+    errors = [0] * concurrency
+    counter = itertools.count()
+    start = time.perf_counter() + 0.05
+
+    def sender(index):
+        send = target.connect()
+        while True:
+            i = next(counter)
+            if i >= n_frames:
+                return
+            due = start + i / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                send(bodies[i % len(bodies)])
+            except Exception:
+                errors[index] += 1
+                continue
+            latencies[i] = time.perf_counter() - due
+
+    threads = [threading.Thread(target=sender, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return latencies[~np.isnan(latencies)], sum(errors), elapsed
+
+
+def run_suite(target, args):
+    results = []
+    for sample_rate, n_cycles in itertools.product(args.sample_rates, args.n_cycles):
+        target.configure(get_configuration(sample_rate, n_cycles))
+
+        for num_channels, concurrency in itertools.product(args.channels, args.concurrency):
+            bodies = get_bodies(num_channels, sample_rate, n_cycles)
+
+            # warm the estimators and connections up, not measured
+            send = target.connect()
+            for i in range(args.warmup):
+                send(bodies[i % len(bodies)])
+
+            latencies, errors, elapsed = run_open_loop(target, bodies, args.rate, concurrency, args.duration)
+
+            result = {
+                "channels": num_channels,
+                "sample_rate": sample_rate,
+                "n_cycles": n_cycles,
+                "concurrency": concurrency,
+                "offered_rate": args.rate,
+                "frames": int(latencies.size),
+                "errors": errors,
+                "frames_per_s": latencies.size / elapsed,
+                "channel_frames_per_s": latencies.size * num_channels / elapsed,
+                "payload_bytes": len(bodies[0])
+            }
+            for name, q in [("p50_ms", 50), ("p99_ms", 99), ("p999_ms", 99.9)]:
+                result[name] = float(np.percentile(latencies, q)) * 1000 if latencies.size else None
+            results.append(result)
+
+            print(f"channels={num_channels} sample_rate={sample_rate} n_cycles={n_cycles} concurrency={concurrency}: "
+                  f"{result['frames_per_s']:.1f} fps, p50 {result['p50_ms'] or 0:.3f} ms, p99 {result['p99_ms'] or 0:.3f} ms, errors {errors}", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against the results of a baseline run."""
+    def key(result):
+        return (result["channels"], result["sample_rate"], result["n_cycles"], result["concurrency"], result["offered_rate"])
+
+    previous = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        if before["p99_ms"] and result["p99_ms"] and result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{key(result)}: p99 {before['p99_ms']:.3f} -> {result['p99_ms']:.3f} ms")
+        if result["frames_per_s"] < before["frames_per_s"] * (1 - tolerance):
+            regressions.append(f"{key(result)}: {before['frames_per_s']:.1f} -> {result['frames_per_s']:.1f} fps")
+        if result["errors"] > before["errors"]:
+            regressions.append(f"{key(result)}: errors {before['errors']} -> {result['errors']}")
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Offline latency and throughput benchmark of the mininube estimation path")
+    parser.add_argument("--target", choices=["inprocess", "server"], default="inprocess",
+                        help="run the estimation path in this process, or against a mininube REST server")
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--server", choices=["flask", "gunicorn"], default="flask",
+                        help="server started by the server target, the development server or gunicorn.conf.py")
+    parser.add_argument("--channels", type=int_list, default=[1, 4, 16])
+    parser.add_argument("--sample-rates", type=int_list, default=[3200, 25600])
+    parser.add_argument("--n-cycles", type=int_list, default=[4])
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8])
+    parser.add_argument("--rate", type=float, default=200.0, help="offered load in frames/s")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per run")
+    parser.add_argument("--warmup", type=int, default=20, help="frames sent before every run")
+    parser.add_argument("--validation", choices=["strict", "fast"], default="strict", help="validation mode of the inprocess target")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="JSON report of an earlier run, exit 1 on regressions against it")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change tolerated against the baseline")
+    args = parser.parse_args()
+
+    if args.target == "server":
+        target = ServerTarget(args.url, args.server)
+    else:
+        target = InProcessTarget(args.validation)
+
+    try:
+        results = run_suite(target, args)
+    finally:
+        target.close()
+
+    report = {
+        "target": target.name,
+        "server": args.server if args.target == "server" and not args.url else None,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "duration": args.duration,
+        "results": results
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("regression:", regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
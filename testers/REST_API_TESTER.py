@@ -1,5 +1,6 @@
 import requests, json
 import base64, struct, math, time
+from signal_generator import generate, encode
 
 class RequestException(Exception):
     pass
@@ -7,17 +8,22 @@ class RequestException(Exception):
 class NodeGatewaySimulator:
     def __init__(self, url = "http://127.0.0.1:5000"):
         self.url = url
+        # one keep-alive connection, so all frames of this gateway reach the same server worker
+        self.session = requests.Session()
+        self.stream_id = None
 
     def post_configure(self, configuration, endpoint = "/configure"):
 
         url = self.url + endpoint
         # Send the POST request with the configuration
-        response = requests.post(url, json={"configuration": configuration})
+        response = self.session.post(url, json={"configuration": configuration})
 
         # Check the response
         if response.status_code == 200:
             # Successful response
             data = response.json()
+            # the stream this gateway estimates on from now on
+            self.stream_id = data.get("stream_id")
             status = data["status"]
             print(f"Configuration status: {status}")
         else:
@@ -29,13 +35,14 @@ class NodeGatewaySimulator:
 
         url = self.url + endpoint
         # Send the POST request with the data frame
-        message= {"data_frame": data_frame}
+        message= {"data_frame": dict(data_frame, stream_id=self.stream_id) if self.stream_id else data_frame}
 
+        # serialized once, for the request and for its size
         json_string = json.dumps(message)
         payload_size = len(json_string)
         print("Payload size:", payload_size, "bytes")
 
-        response = requests.post(url, json=message)
+        response = self.session.post(url, data=json_string, headers={"Content-Type": "application/json"})
 
         # Check the response
         if response.status_code == 200:
@@ -43,22 +50,62 @@ class NodeGatewaySimulator:
         else:
             raise RequestException(response.text)
 
+    def get_estimate_binary(self, data_frame, endpoint = "/estimate/bin"):
+
+        url = self.url + endpoint
+        # Send the same data frame in the binary encoding
+        message = self.encode_binary_frame(data_frame)
+
+        payload_size = len(message)
+        print("Payload size:", payload_size, "bytes")
+
+        response = self.session.post(url, data=message, headers={"Content-Type": "application/octet-stream"}, params={"stream_id": self.stream_id} if self.stream_id else None)
+
+        # Check the response
+        if response.status_code == 200:
+            return self.decode_binary_result(response.content)
+        else:
+            raise RequestException(response.text)
+
     @staticmethod
-    def get_encoded_signal(nominal_freq = 50, amplitude = 1.0 ,phase = 0, frequency = 51.0, sampling_rate = 25600, n_cycles = 4):
+    def encode_binary_frame(data_frame):
+        # header: SOC, FRACSEC, timebase, channel count, version 1
+        timestamp = data_frame["timestamp"]
+        parts = [struct.pack("<IIIHH", timestamp["SOC"], timestamp["FRACSEC"], timestamp["timebase"], len(data_frame["channels"]), 1)]
 
-        num_samples = n_cycles*sampling_rate//nominal_freq
-        samples = []
+        # per channel: channel number, reserved, sample count, raw float64 samples
+        for channel in data_frame["channels"]:
+            byte_data = base64.b64decode(channel["payload"])
+            parts.append(struct.pack("<HHI", channel["channel_number"], 0, len(byte_data) // 8))
+            parts.append(byte_data)
+
+        return b"".join(parts)
+
+    @staticmethod
+    def decode_binary_result(body):
+        # header as in the request, then one 40 byte record per channel:
+        # channel number, configuration generation, amplitude, phase, frequency, rocof
+        _, _, _, n_channels, _ = struct.unpack_from("<IIIHH", body, 0)
+
+        frame = {}
+        generation = None
+        for i in range(n_channels):
+            channel_number, generation, amplitude, phase, frequency, rocof = struct.unpack_from("<II4d", body, 16 + 40 * i)
+            frame["channel_" + str(channel_number)] = {
+                "synchrophasor": {"amplitude": amplitude, "phase": phase},
+                "frequency": frequency,
+                "rocof": rocof
+            }
+
+        return {"frame": frame, "generation": generation}
 
-        for i in range(num_samples):
-            time = i / sampling_rate
-            sample = amplitude * math.sin(2 * math.pi * frequency * time + phase)
-            samples.append(sample)
+    @staticmethod
+    def get_encoded_signal(nominal_freq = 50, amplitude = 1.0 ,phase = 0, frequency = 51.0, sampling_rate = 25600, n_cycles = 4):
 
-        # Convert the samples to a bytes object using double precision
-        byte_data = b"".join(struct.pack("d", sample) for sample in samples)
+        num_samples = n_cycles*sampling_rate//nominal_freq
 
-        # Encode the bytes data to base64
-        return base64.b64encode(byte_data).decode("utf-8")
+        # amplitude * sin(2 pi f t + phase), as double precision base64
+        return encode(generate(num_samples, sampling_rate, nominal_freq=nominal_freq, frequency=frequency, amplitude=amplitude, phase=phase - math.pi/2)[0])
 
 
 if __name__ == "__main__":
@@ -122,21 +169,22 @@ if __name__ == "__main__":
             "payload": encoded_signal
         })
 
-    # Get the estimate
-    try:
-        iterations = 4
-        start = time.time()
-
-        for i in range(0, iterations):
-            estimate = node_gateway.get_estimate(data_frame)
-
-        end = time.time()
-        time_per_iter = (end - start)/iterations
-        print("Frame rate:", 1/time_per_iter, " fps")
-        print("Time:", time_per_iter*1000, " ms")
-        print(estimate)
-    except Exception as e:
-        print(e)
+    # Get the estimate, once with the JSON and once with the binary encoding
+    for encoding, get_estimate in [("json", node_gateway.get_estimate), ("binary", node_gateway.get_estimate_binary)]:
+        try:
+            iterations = 4
+            start = time.time()
+
+            for i in range(0, iterations):
+                estimate = get_estimate(data_frame)
+
+            end = time.time()
+            time_per_iter = (end - start)/iterations
+            print(f"[{encoding}] Frame rate:", 1/time_per_iter, " fps")
+            print(f"[{encoding}] Time:", time_per_iter*1000, " ms")
+            print(estimate)
+        except Exception as e:
+            print(e)
     
     
 
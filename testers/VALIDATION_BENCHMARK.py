@@ -0,0 +1,31 @@
+import os, sys, timeit
+from jsonschema import validate
+from signal_generator import Scenario
+
+# the schemas live next to the server scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pmu_schemas import DATA_FRAME_SCHEMA, validate_data_frame
+
+
+def get_data_frame(num_channels, sampling_rate = 51200, n_cycles = 4, nominal_freq = 50):
+    return Scenario(num_channels, sampling_rate, n_cycles, nominal_freq).data_frame()
+
+
+if __name__ == "__main__":
+
+    iterations = 2000
+
+    print(f"{'channels':>8} {'jsonschema.validate':>20} {'strict (compiled)':>18} {'fast':>10}   [us per frame]")
+
+    for num_channels in [1, 4, 16]:
+        data_frame = get_data_frame(num_channels)
+
+        modes = [
+            lambda: validate(data_frame, DATA_FRAME_SCHEMA),
+            lambda: validate_data_frame(data_frame, "strict"),
+            lambda: validate_data_frame(data_frame, "fast")
+        ]
+
+        times = [min(timeit.repeat(mode, number=iterations, repeat=5)) / iterations * 1e6 for mode in modes]
+
+        print(f"{num_channels:>8} {times[0]:>20.2f} {times[1]:>18.2f} {times[2]:>10.2f}")
@@ -2,14 +2,13 @@ import asyncio
 import websockets
 import json
 import time
-import base64
-import struct
 import math
 import threading
 from pythonping import ping
 import speedtest
 import csv
 import statistics
+from signal_generator import generate, encode
 
 class WebsocketGatewaySimulator:
     def __init__(self, url="wss://pp06w1fdrj.execute-api.eu-north-1.amazonaws.com/dev"):
@@ -48,18 +47,9 @@ class WebsocketGatewaySimulator:
     @staticmethod
     def get_encoded_signal(nominal_freq=50, amplitude=1.0, phase=0, frequency=51.0, sampling_rate=25600, n_cycles=4):
         num_samples = n_cycles * sampling_rate // nominal_freq
-        samples = []
 
-        for i in range(num_samples):
-            t = i / sampling_rate
-            sample = amplitude * math.sin(2 * math.pi * frequency * t + phase)
-            samples.append(sample)
-
-        # Convert the samples to a bytes object using double precision
-        byte_data = b"".join(struct.pack("d", sample) for sample in samples)
-
-        # Encode the bytes data to base64
-        return base64.b64encode(byte_data).decode("utf-8")
+        # amplitude * sin(2 pi f t + phase), as double precision base64
+        return encode(generate(num_samples, sampling_rate, nominal_freq=nominal_freq, frequency=frequency, amplitude=amplitude, phase=phase - math.pi/2)[0])
 
 class CBPMUPerformanceEvaluation:
     def __init__(self, filename):
@@ -0,0 +1,120 @@
+import base64
+import json
+import numpy as np
+
+
+def generate(n_samples, sample_rate, start = 0, n_channels = 1, nominal_freq = 50.0, frequency = None, amplitude = 1.0,
+             phase = 0.0, phase_step = 0.0, rocof = 0.0, am = (0.0, 0.0), pm = (0.0, 0.0), harmonics = (),
+             interharmonics = (), noise = 0.0, seed = 0):
+    """Return n_channels x n_samples test waveform samples, starting at sample start.
+
+    The fundamental follows the IEC/IEEE 60255-118-1 test signals:
+
+        amplitude * (1 + kx cos(2 pi fx t)) * cos(2 pi f t + pi rocof t^2 + phase + ka cos(2 pi fa t - pi))
+
+    with am = (kx, fx), pm = (ka, fa) and f = frequency (nominal_freq when
+    None). Channel c is shifted by c * phase_step, e.g. -2 pi / 3 for a three
+    phase set. harmonics are (order, relative magnitude) pairs riding on the
+    fundamental, interharmonics (frequency, relative magnitude) pairs, noise
+    the standard deviation of added white noise.
+    """
+    if frequency is None:
+        frequency = nominal_freq
+
+    t = (start + np.arange(n_samples)) / sample_rate
+    offsets = phase + phase_step * np.arange(n_channels)[:, None]
+
+    angle = 2 * np.pi * frequency * t + np.pi * rocof * t * t + pm[0] * np.cos(2 * np.pi * pm[1] * t - np.pi)
+    envelope = amplitude * (1 + am[0] * np.cos(2 * np.pi * am[1] * t))
+
+    samples = np.cos(angle + offsets)
+    for order, magnitude in harmonics:
+        samples += magnitude * np.cos(order * (angle + offsets))
+    for interharmonic_freq, magnitude in interharmonics:
+        samples += magnitude * np.cos(2 * np.pi * interharmonic_freq * t + offsets)
+    samples *= envelope
+
+    if noise:
+        rng = np.random.default_rng(seed + start)
+        samples += rng.normal(0.0, noise * amplitude, samples.shape)
+
+    return samples
+
+
+def encode(samples):
+    """Base64 payload of one channel, as sent in data frames."""
+    return base64.b64encode(np.ascontiguousarray(samples, dtype="<f8").tobytes()).decode("utf-8")
+
+
+class Scenario:
+    """A test signal cut into the windows of consecutive data frames.
+
+    Window i starts i * sample_rate / frame_rate samples into the signal and
+    is n_cycles nominal cycles long. The base64 payloads of the first
+    n_frames windows are computed in one go on first use and cached, so
+    looping over them to produce data frames costs next to nothing; with
+    a periodic signal, n_frames = frame_rate covers whole seconds of it.
+    """
+
+    def __init__(self, n_channels = 1, sample_rate = 25600, n_cycles = 4, nominal_freq = 50, frame_rate = 50, **signal):
+        self.n_channels = n_channels
+        self.sample_rate = sample_rate
+        self.n_cycles = n_cycles
+        self.nominal_freq = nominal_freq
+        self.frame_rate = frame_rate
+        self.signal = signal
+        self.window_size = n_cycles * sample_rate // nominal_freq
+        self.step = sample_rate // frame_rate
+        self._payloads = {}
+        self._channels_json = {}
+
+    def samples(self, start, n_samples):
+        return generate(n_samples, self.sample_rate, start, self.n_channels, self.nominal_freq, **self.signal)
+
+    def windows(self, n_frames, first = 0):
+        """Return the n_frames x n_channels x window_size sample windows starting with frame first."""
+        stream = self.samples(first * self.step, (n_frames - 1) * self.step + self.window_size)
+        view = np.lib.stride_tricks.sliding_window_view(stream, self.window_size, axis=1)[:, ::self.step]
+        return view.transpose(1, 0, 2)
+
+    def payloads(self, n_frames = 1):
+        """Return the cached base64 payloads, one list of n_channels per frame."""
+        payloads = self._payloads.get(n_frames)
+        if payloads is None:
+            payloads = self._payloads[n_frames] = [[encode(channel) for channel in frame] for frame in self.windows(n_frames)]
+        return payloads
+
+    def timestamp(self, index, soc = 123456789):
+        seconds, frame = divmod(index, self.frame_rate)
+        return {"SOC": soc + seconds, "FRACSEC": frame * 1000000 // self.frame_rate, "timebase": 1000000}
+
+    def channels(self, index = 0, n_frames = 1):
+        frame_payloads = self.payloads(n_frames)[index % n_frames]
+        return [{"channel_number": i, "payload": payload} for i, payload in enumerate(frame_payloads, 1)]
+
+    def data_frame(self, index = 0, n_frames = 1, soc = 123456789):
+        """Data frame of frame index, cycling through the n_frames cached windows."""
+        return {"timestamp": self.timestamp(index, soc), "channels": self.channels(index, n_frames)}
+
+    def data_frames(self, count, n_frames = 1, soc = 123456789):
+        for index in range(count):
+            yield self.data_frame(index, n_frames, soc)
+
+    def chunk_frame(self, index = 0, soc = 123456789):
+        """Data frame of frame index for /estimate/incremental, holding only the samples new since frame index - 1."""
+        if index == 0:
+            chunk = self.samples(0, self.window_size)
+        else:
+            chunk = self.samples((index - 1) * self.step + self.window_size, self.step)
+        return {
+            "timestamp": self.timestamp(index, soc),
+            "channels": [{"channel_number": i, "payload": encode(samples)} for i, samples in enumerate(chunk, 1)]
+        }
+
+    def request_body(self, index = 0, n_frames = 1, soc = 123456789):
+        """JSON /estimate request body of data_frame(index), without serializing the payloads again."""
+        key = (n_frames, index % n_frames)
+        channels_json = self._channels_json.get(key)
+        if channels_json is None:
+            channels_json = self._channels_json[key] = json.dumps(self.channels(index, n_frames))
+        return '{"data_frame": {"timestamp": ' + json.dumps(self.timestamp(index, soc)) + ', "channels": ' + channels_json + '}}'
@@ -0,0 +1,11 @@
+import importlib.util
+import os
+import sys
+
+# the server script's name is not a valid module name, load it by path
+_spec = importlib.util.spec_from_file_location("mininube_rest_api", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mininube-rest-api.py"))
+mininube = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = mininube
+_spec.loader.exec_module(mininube)
+
+app = application = mininube.mininubePMU